@@ -0,0 +1,296 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark for the downloaders, run against a local stand-in HTTP server so results can be repeated and compared between versions.
+
+The server runs in its own process and makes up its responses: files of any size (with 'Content-Length', 'ETag' and Range support), chains of redirects, 'Content-Disposition' filenames, HTML pages, slow responses and HTTP errors. The synthetic files start with a PDF header so they are recognised without ExifTool.
+
+The benchmark drives "downloader.download_from_list" and/or the light "DownloadResource" over a mix of those URLs and reports URLs/s, MB/s, p50/p99 latency per resource and peak memory (RSS). Each run is made in a fresh process, so its peak memory is its own and not that of an earlier run.
+
+Example:
+
+	python benchmark.py --urls 500 --size 1m --workers 8 --json results.json
+
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import downloader
+import downloader_light_modified
+import rate_limiter
+
+try:
+	import resource
+except ImportError:
+	# not available on Windows
+	resource = None
+
+CHUNK = b"\0" * 65536
+FILE_HEADER = b"%PDF-1.4\n"
+
+class StandInHandler(BaseHTTPRequestHandler):
+	"""Answers requests to the stand-in server. Paths:
+
+	/file/<bytes>                      a file of that many bytes
+	/disposition/<bytes>               a file with a 'Content-Disposition' filename
+	/redirect/<hops>/<bytes>           that many 302 redirects, then a file
+	/slow/<milliseconds>/<bytes>       a file sent after a delay
+	/html                              a small web page
+	/error/<status>                    an empty response with that status
+
+	Anything after these is ignored, so URLs can be made unique with an extra path segment. (The downloader drops query strings, so "?n=1" would not do.)
+	"""
+
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, format, *args):
+		pass
+
+	def handle(self):
+		# the downloaders hang up early on purpose, eg on HTML pages, so a dropped connection isn't an error here
+		try:
+			super().handle()
+		except (ConnectionResetError, BrokenPipeError):
+			pass
+
+	def do_HEAD(self):
+		self.respond(send_body=False)
+
+	def do_GET(self):
+		self.respond(send_body=True)
+
+	def respond(self, send_body):
+		parts = self.path.split("?")[0].strip("/").split("/")
+		kind = parts[0]
+		if kind == "redirect" and int(parts[1]) > 0:
+			self.send_response(302)
+			self.send_header("Location", "/".join(["", "redirect", str(int(parts[1]) - 1)] + parts[2:]))
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+		elif kind == "redirect":
+			self.send_file(int(parts[2]), send_body)
+		elif kind == "slow":
+			time.sleep(int(parts[1]) / 1000)
+			self.send_file(int(parts[2]), send_body)
+		elif kind == "disposition":
+			self.send_file(int(parts[1]), send_body, {"Content-Disposition": 'attachment; filename="report.pdf"'})
+		elif kind == "file":
+			self.send_file(int(parts[1]), send_body)
+		elif kind == "html":
+			page = b"<!DOCTYPE html><html><head><title>Landing page</title></head><body>" + b"<p>text</p>" * 200 + b"</body></html>"
+			self.send_response(200)
+			self.send_header("Content-Type", "text/html; charset=utf-8")
+			self.send_header("Content-Length", str(len(page)))
+			self.end_headers()
+			if send_body:
+				self.wfile.write(page)
+		elif kind == "error":
+			self.send_response(int(parts[1]))
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+		else:
+			self.send_response(404)
+			self.send_header("Content-Length", "0")
+			self.end_headers()
+
+	def send_file(self, size, send_body, extra_headers=None):
+		start, end = 0, size - 1
+		range_header = self.headers.get("Range")
+		if range_header and range_header.startswith("bytes="):
+			first, last = range_header[len("bytes="):].split("-")
+			start = int(first)
+			end = int(last) if last else size - 1
+			self.send_response(206)
+			self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+		else:
+			self.send_response(200)
+		self.send_header("Content-Type", "application/pdf")
+		self.send_header("Content-Length", str(end + 1 - start))
+		self.send_header("Accept-Ranges", "bytes")
+		self.send_header("ETag", f'"{size}"')
+		for header, value in (extra_headers or {}).items():
+			self.send_header(header, value)
+		self.end_headers()
+		if send_body:
+			self.write_body(start, end + 1)
+
+	def write_body(self, start, stop):
+		position = start
+		# the header sits at the start of the file, so only ranges that include byte 0 send it
+		if position < len(FILE_HEADER):
+			piece = FILE_HEADER[position:stop]
+			self.wfile.write(piece)
+			position += len(piece)
+		while position < stop:
+			piece = CHUNK[:stop - position]
+			self.wfile.write(piece)
+			position += len(piece)
+
+def _serve(port_queue):
+	server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+	server.daemon_threads = True
+	port_queue.put(server.server_address[1])
+	server.serve_forever()
+
+def start_server():
+	"""Starts the stand-in server in its own process and returns (process, base URL)
+	"""
+	port_queue = multiprocessing.Queue()
+	process = multiprocessing.Process(target=_serve, args=(port_queue,), daemon=True)
+	process.start()
+	return process, f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+def parse_size(text):
+	"""Turns sizes like "512", "64k" or "10m" into bytes
+	"""
+	multipliers = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+	text = text.strip().lower()
+	if text[-1:] in multipliers:
+		return int(float(text[:-1]) * multipliers[text[-1]])
+	return int(text)
+
+def make_urls(base_url, count, size, redirects, slow_ms, html_share, error_share, seed):
+	"""Makes a shuffled mix of stand-in URLs: mostly plain files, with redirect chains, 'Content-Disposition' files, slow files, HTML pages and errors mixed in
+	"""
+	chooser = random.Random(seed)
+	urls = []
+	for number in range(count):
+		roll = chooser.random()
+		if roll < html_share:
+			urls.append(f"{base_url}/html/{number}")
+		elif roll < html_share + error_share:
+			urls.append(f"{base_url}/error/{chooser.choice([404, 500, 503])}/{number}")
+		else:
+			kind = chooser.choice(["file", "file", "disposition", "redirect", "slow"])
+			if kind == "redirect":
+				urls.append(f"{base_url}/redirect/{redirects}/{size}/{number}")
+			elif kind == "slow":
+				urls.append(f"{base_url}/slow/{slow_ms}/{size}/{number}")
+			else:
+				urls.append(f"{base_url}/{kind}/{size}/{number}")
+	return urls
+
+def peak_rss_mb():
+	"""Peak resident memory of this process in MB, or None where it can't be measured
+	"""
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports KB, macOS reports bytes
+	return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def percentile(values, fraction):
+	if not values:
+		return None
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def summarise(name, seconds, latencies, bytes_downloaded, urls):
+	return {
+		"run": name,
+		"urls": len(urls),
+		"seconds": round(seconds, 3),
+		"urls_per_second": round(len(urls) / seconds, 2),
+		"mb_per_second": round(bytes_downloaded / (1024 * 1024) / seconds, 2),
+		"latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+		"latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+		"peak_rss_mb": round(peak_rss_mb(), 1) if resource is not None else None,
+	}
+
+def run_isolated(bench, *args):
+	"""Runs bench(*args) in a fresh process and returns its result, so the process's peak RSS belongs to that run alone
+	"""
+	with multiprocessing.get_context("spawn").Pool(1) as pool:
+		return pool.apply(bench, args)
+
+def bench_download_from_list(urls, directory, workers, per_host, rate):
+	"""Times downloader.download_from_list over urls, timing each DownloadResource as it is made
+	"""
+	latencies = []
+	limiter = rate_limiter.RateLimiter(rate=rate)
+	original_class = downloader.DownloadResource
+
+	class TimedDownloadResource(original_class):
+		def __init__(self, *args, **kwargs):
+			started = time.perf_counter()
+			super().__init__(*args, **kwargs)
+			latencies.append(time.perf_counter() - started)
+
+	downloader.start_database(os.path.join(directory, "benchmark.db"), reset_db=True)
+	# download_from_list looks DownloadResource up when it runs, so the timed class is picked up for this run only
+	downloader.DownloadResource = TimedDownloadResource
+	try:
+		started = time.perf_counter()
+		downloader.download_from_list(urls, directory=os.path.join(directory, "list"), max_workers=workers, max_per_host=per_host, rate_limiter=limiter)
+		seconds = time.perf_counter() - started
+	finally:
+		downloader.DownloadResource = original_class
+	downloaded = sum(os.path.getsize(entry.path) for entry in os.scandir(os.path.join(directory, "list")) if entry.is_file())
+	return summarise("download_from_list", seconds, latencies, downloaded, urls)
+
+def bench_light(urls, directory, rate):
+	"""Times the light DownloadResource over urls, one after another
+	"""
+	latencies = []
+	limiter = rate_limiter.RateLimiter(rate=rate)
+	downloaded = 0
+	started = time.perf_counter()
+	for url in urls:
+		resource_started = time.perf_counter()
+		target_resource = downloader_light_modified.DownloadResource(url, os.path.join(directory, "light"), False, None, rate_limiter=limiter)
+		latencies.append(time.perf_counter() - resource_started)
+		if target_resource.download_status == True and target_resource.filesize:
+			downloaded += target_resource.filesize
+	seconds = time.perf_counter() - started
+	return summarise("light DownloadResource", seconds, latencies, downloaded, urls)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the downloaders against a local stand-in HTTP server.")
+	parser.add_argument("--urls", type=int, default=200, help="number of URLs in the mix (default 200)")
+	parser.add_argument("--size", default="256k", help="size of each synthetic file, eg 512, 64k, 10m (default 256k)")
+	parser.add_argument("--redirects", type=int, default=3, help="hops in each redirect chain (default 3)")
+	parser.add_argument("--slow-ms", type=int, default=200, help="delay before slow responses, in ms (default 200)")
+	parser.add_argument("--html-share", type=float, default=0.1, help="share of URLs that are HTML pages (default 0.1)")
+	parser.add_argument("--error-share", type=float, default=0.05, help="share of URLs that return HTTP errors (default 0.05)")
+	parser.add_argument("--workers", type=int, default=8, help="max_workers for download_from_list (default 8)")
+	parser.add_argument("--per-host", type=int, default=8, help="max_per_host for download_from_list (default 8)")
+	parser.add_argument("--rate", type=float, default=0, help="requests per second allowed to the stand-in host, 0 for no limit (default 0)")
+	parser.add_argument("--mode", choices=["list", "light", "both"], default="both", help="which downloader to run (default both)")
+	parser.add_argument("--seed", type=int, default=1, help="seed for the URL mix, so runs can be compared (default 1)")
+	parser.add_argument("--json", help="also write the results to this file")
+	args = parser.parse_args(argv)
+
+	logging.getLogger().setLevel(logging.ERROR)
+	server_process, base_url = start_server()
+	directory = tempfile.mkdtemp(prefix="downloader_benchmark_")
+	urls = make_urls(base_url, args.urls, parse_size(args.size), args.redirects, args.slow_ms, args.html_share, args.error_share, args.seed)
+	results = []
+	try:
+		if args.mode in ("list", "both"):
+			results.append(run_isolated(bench_download_from_list, urls, directory, args.workers, args.per_host, args.rate))
+		if args.mode in ("light", "both"):
+			results.append(run_isolated(bench_light, urls, directory, args.rate))
+	finally:
+		server_process.terminate()
+		shutil.rmtree(directory, ignore_errors=True)
+
+	for result in results:
+		print(f"{result['run']}: {result['urls']} URLs in {result['seconds']}s - {result['urls_per_second']} URLs/s, {result['mb_per_second']} MB/s, "
+			f"p50 {result['latency_p50_ms']} ms, p99 {result['latency_p99_ms']} ms, peak RSS {result['peak_rss_mb']} MB")
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({"settings": vars(args), "results": results}, f, indent=2)
+	return results
+
+if __name__ == "__main__":
+	main()
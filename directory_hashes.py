@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+
+"""
+Module to compare the files in a download directory by their hashes, without hashing again the files that haven't changed since last time.
+
+Function "hash_file" hashes one file with large reads. hashlib lets other threads run while it hashes, so several files are hashed at once on threads.
+
+Class "HashCache" keeps the digests in an SQLite database, keyed by path, size and modification time, so a file is only hashed again if it changes.
+
+Function "scan_directory" walks a directory, hashing the new and changed files in parallel and taking the rest from the cache, and yields the path, size and digest of every file.
+
+Function "find_duplicates" yields the groups of files in the directory sharing a hash. Function "compare_with_database" yields the downloaded files whose hash no longer matches the one recorded in the downloader's Resources table, or that have gone.
+
+Run it from the command line to do all three:
+
+	python directory_hashes.py content --database files_from_urls.db
+
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import downloader
+import hashlib
+import itertools
+import logging
+import os
+import peewee
+import time
+
+# bytes read from a file per hash update
+HASH_CHUNK_SIZE = 1024 * 1024
+# files looked up, hashed and written to the cache together
+SCAN_CHUNK = 500
+
+class FileHashes(peewee.Model):
+	"""Creates the cache table. Bound to a database by HashCache.
+	...
+
+	Database fields
+	----------
+		path : str
+			Absolute path of the file
+		hash_name : str
+			"md5", "sha1" or "sha256"
+		size : int
+			Size of the file in bytes when it was hashed
+		mtime_ns : int
+			Modification time of the file in nanoseconds when it was hashed
+		digest : str
+			Hex digest of the file
+		seen : float
+			Unix time of the last scan that found the file
+	"""
+
+	path = peewee.CharField(max_length=1000)
+	hash_name = peewee.CharField(max_length=10)
+	size = peewee.IntegerField()
+	mtime_ns = peewee.IntegerField()
+	digest = peewee.CharField(max_length=64)
+	seen = peewee.FloatField()
+
+	class Meta:
+		indexes = (
+			(("path", "hash_name"), True),
+			(("hash_name", "digest"), False),
+		)
+
+class HashCache:
+	"""Keeps file digests in an SQLite database, creating it if it doesn't exist. A digest is used again as long as the file's size and modification time are the same.
+	...
+	Parameters
+	----------
+	database_path : str, optional
+		Path of the cache database. Default is "hash_cache.db" in the current directory.
+
+	METHODS
+	-------
+
+	get_many
+	put_many
+	mark_seen
+	forget_unseen
+	close
+	"""
+
+	def __init__(self, database_path="hash_cache.db"):
+		self.database = peewee.SqliteDatabase(database_path, pragmas={"journal_mode": "wal", "synchronous": "normal"})
+		FileHashes.bind(self.database)
+		self.database.create_tables([FileHashes], safe=True)
+
+	def get_many(self, hash_name, paths):
+		"""Returns a dictionary of path to (size, mtime_ns, digest) for the given paths that are in the cache
+		"""
+		query = (FileHashes
+			.select(FileHashes.path, FileHashes.size, FileHashes.mtime_ns, FileHashes.digest)
+			.where((FileHashes.hash_name == hash_name) & FileHashes.path.in_(list(paths)))
+			.tuples())
+		return {path: (size, mtime_ns, digest) for path, size, mtime_ns, digest in query}
+
+	def put_many(self, hash_name, rows, seen):
+		"""Stores (path, size, mtime_ns, digest) rows in one transaction, replacing what was cached for those paths
+		"""
+		rows = [{"path": path, "hash_name": hash_name, "size": size, "mtime_ns": mtime_ns, "digest": digest, "seen": seen} for path, size, mtime_ns, digest in rows]
+		if rows:
+			with self.database.atomic():
+				FileHashes.insert_many(rows).on_conflict_replace().execute()
+
+	def mark_seen(self, hash_name, paths, seen):
+		"""Records that a scan found the given cached paths unchanged
+		"""
+		paths = list(paths)
+		if paths:
+			FileHashes.update(seen=seen).where((FileHashes.hash_name == hash_name) & FileHashes.path.in_(paths)).execute()
+
+	def forget_unseen(self, hash_name, directory, seen):
+		"""Deletes the cached files under directory that the scan started at seen didn't find, and returns how many there were
+		"""
+		return (FileHashes
+			.delete()
+			.where((FileHashes.hash_name == hash_name) & _under(directory) & (FileHashes.seen < seen))
+			.execute())
+
+	def close(self):
+		self.database.close()
+
+def _under(directory):
+	"""Query condition matching cached paths inside directory
+	"""
+	prefix = os.path.join(os.path.abspath(directory), "")
+	return peewee.fn.substr(FileHashes.path, 1, len(prefix)) == prefix
+
+def _chunks(iterable, size):
+	iterator = iter(iterable)
+	while True:
+		chunk = list(itertools.islice(iterator, size))
+		if not chunk:
+			return
+		yield chunk
+
+def hash_file(path, hash_name="md5", chunk_size=HASH_CHUNK_SIZE):
+	"""Returns the hex digest of a file, reading it into one reused buffer in large chunks
+	"""
+	digest = hashlib.new(hash_name)
+	buffer = bytearray(chunk_size)
+	view = memoryview(buffer)
+	with open(path, "rb", buffering=0) as f:
+		while True:
+			read = f.readinto(buffer)
+			if not read:
+				break
+			digest.update(view[:read])
+	return digest.hexdigest()
+
+def iter_files(directory):
+	"""Yields (absolute path, size, mtime_ns) for every file under directory, going into subdirectories. Symlinks and the ".part" files of unfinished downloads are left out.
+	"""
+	stack = [os.path.abspath(directory)]
+	while stack:
+		try:
+			entries = os.scandir(stack.pop())
+		except OSError as e:
+			logging.warning(f"Could not read directory: {e}")
+			continue
+		with entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					stack.append(entry.path)
+				elif entry.is_file(follow_symlinks=False) and not entry.name.endswith(".part"):
+					stat = entry.stat(follow_symlinks=False)
+					yield entry.path, stat.st_size, stat.st_mtime_ns
+
+def _hash_or_none(path, hash_name):
+	"""Hashes a file for scan_directory, logging and returning None if it has gone or can't be read
+	"""
+	try:
+		return hash_file(path, hash_name)
+	except OSError as e:
+		logging.warning(f"Could not hash '{path}': {e}")
+		return None
+
+def scan_directory(directory, cache, hash_name="md5", workers=None):
+	"""Yields (path, size, digest) for every file under directory, hashing only the files that are new or have changed since they were cached.
+	Once every file has been yielded, files cached under directory that no longer exist are forgotten.
+	...
+	Parameters
+	----------
+	directory : str
+		Directory to scan, eg the directory given to the downloader
+	cache : HashCache
+		Cache to take digests from and store new ones in
+	hash_name : str, optional
+		Hash to compute, from "md5", "sha1" and "sha256". Default is "md5", as recorded by the downloader.
+	workers : int, optional
+		Number of files hashed at the same time. Default is None: as many as ThreadPoolExecutor allows by default.
+	"""
+	seen = time.time()
+	counts = {"files": 0, "hashed": 0}
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for chunk in _chunks(iter_files(directory), SCAN_CHUNK):
+			cached = cache.get_many(hash_name, (path for path, _, _ in chunk))
+			unchanged, changed = [], []
+			for path, size, mtime_ns in chunk:
+				hit = cached.get(path)
+				if hit is not None and hit[:2] == (size, mtime_ns):
+					unchanged.append((path, size, hit[2]))
+				else:
+					changed.append((path, size, mtime_ns))
+			digests = executor.map(_hash_or_none, [path for path, _, _ in changed], itertools.repeat(hash_name))
+			hashed = [(path, size, mtime_ns, digest) for (path, size, mtime_ns), digest in zip(changed, digests) if digest is not None]
+			cache.put_many(hash_name, hashed, seen)
+			cache.mark_seen(hash_name, (path for path, _, _ in unchanged), seen)
+			counts["files"] += len(unchanged) + len(hashed)
+			counts["hashed"] += len(hashed)
+			yield from unchanged
+			for path, size, _, digest in hashed:
+				yield path, size, digest
+	forgotten = cache.forget_unseen(hash_name, directory, seen)
+	logging.info(f"Scanned {counts['files']} files in '{directory}': {counts['hashed']} hashed, {counts['files'] - counts['hashed']} from the cache, {forgotten} gone")
+
+def find_duplicates(cache, directory, hash_name="md5"):
+	"""Yields (digest, list of paths) for every digest shared by more than one cached file under directory. Run scan_directory first so the cache is up to date.
+	Hardlinked files, eg from a ContentStore, are listed as duplicates too.
+	"""
+	in_directory = (FileHashes.hash_name == hash_name) & _under(directory)
+	duplicate_digests = (FileHashes
+		.select(FileHashes.digest)
+		.where(in_directory)
+		.group_by(FileHashes.digest)
+		.having(peewee.fn.COUNT(FileHashes.id) > 1))
+	query = (FileHashes
+		.select(FileHashes.digest, FileHashes.path)
+		.where(in_directory & FileHashes.digest.in_(duplicate_digests))
+		.order_by(FileHashes.digest, FileHashes.path)
+		.tuples())
+	for digest, rows in itertools.groupby(query.iterator(), key=lambda row: row[0]):
+		yield digest, [path for _, path in rows]
+
+def compare_with_database(cache, directory, hash_name="md5"):
+	"""Yields (record id, filepath, recorded digest, digest on disk) for every successful Resources record with a file under directory whose hash doesn't match the cache. The digest on disk is None if the file has gone.
+	Needs the downloader's database started (downloader.start_database) and scan_directory run first. Relative filepaths in Resources are taken from the current directory, as the downloader saved them.
+	"""
+	column = getattr(downloader.Resources, hash_name)
+	prefix = os.path.join(os.path.abspath(directory), "")
+	query = (downloader.Resources
+		.select(downloader.Resources.id, downloader.Resources.filepath, column)
+		.where((downloader.Resources.download_status == True) & downloader.Resources.filepath.is_null(False) & column.is_null(False))
+		.order_by(downloader.Resources.id)
+		.tuples())
+	records = ((record_id, filepath, os.path.abspath(filepath), recorded) for record_id, filepath, recorded in query.iterator())
+	for chunk in _chunks((record for record in records if record[2].startswith(prefix)), SCAN_CHUNK):
+		cached = cache.get_many(hash_name, (path for _, _, path, _ in chunk))
+		for record_id, filepath, path, recorded in chunk:
+			on_disk = cached[path][2] if path in cached else None
+			if on_disk != recorded:
+				yield record_id, filepath, recorded, on_disk
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Hash the files in a download directory, list duplicates and check them against the downloader's database.")
+	parser.add_argument("directory", help="directory to scan")
+	parser.add_argument("--cache", default="hash_cache.db", help="hash cache database (default hash_cache.db)")
+	parser.add_argument("--database", help="downloader database to check the hashes against, eg files_from_urls.db")
+	parser.add_argument("--hash", default="md5", choices=["md5", "sha1", "sha256"], help="hash to use (default md5)")
+	parser.add_argument("--workers", type=int, help="files hashed at the same time")
+	args = parser.parse_args(argv)
+
+	cache = HashCache(args.cache)
+	started = time.perf_counter()
+	files = sum(1 for _ in scan_directory(args.directory, cache, args.hash, args.workers))
+	print(f"{files} files scanned in {time.perf_counter() - started:.1f}s")
+
+	groups = 0
+	for digest, paths in find_duplicates(cache, args.directory, args.hash):
+		groups += 1
+		print(f"Duplicate {digest}:")
+		for path in paths:
+			print(f"\t{path}")
+	print(f"{groups} groups of duplicates")
+
+	if args.database:
+		downloader.start_database(args.database)
+		mismatches = 0
+		for record_id, filepath, recorded, on_disk in compare_with_database(cache, args.directory, args.hash):
+			mismatches += 1
+			print(f"Record {record_id} '{filepath}': recorded {recorded}, " + (f"now {on_disk}" if on_disk else "file missing"))
+		print(f"{mismatches} records don't match their files")
+	cache.close()
+
+if __name__ == "__main__":
+	main()
@@ -9,25 +9,52 @@ Assigns filenames by minting a UUID, but also returns original filenames as pars
 
 Function "download_file_from_url" runs a single URL through Download Resource, downloads the resource and downloads the new database ID for it.
 
-Function "download_from_list" takes a list, tuple or set of URLs and passes each one to DownloadResource - downloads the resources and returns a list of dictionaries with each original url and its new database ID.
+Function "download_from_list" takes a list, tuple or set of URLs - or any iterable, or the path of a file of URLs - and passes each one to DownloadResource - downloads the resources and returns a list of dictionaries with each original url and its new database ID.
+Function "iter_download_from_list" does the same as a generator, yielding each dictionary as soon as its resource is finished. Both read the URLs only as they are needed, so memory use doesn't grow with the length of the input.
+Pass max_workers > 1 to download several resources at once; max_per_host stops any single host receiving more than that many requests at a time. Requests to each host are also held to a polite rate by the shared limiter in rate_limiter.py.
+Pass a RunMetrics from run_metrics.py as metrics to watch progress, throughput and failures while a long list runs.
+Pass a job_batch name to keep the list as a queue of jobs in the database (see job_queue.py), so a run that is interrupted carries on where it stopped when started again.
+Pass a PostProcessor from postprocess.py as post_processor to read file types and run ExifTool on a separate pool of processes, so the download workers only download.
 
 You may wish to first run "start_database" if you want to provide a path for your database, and/or to reset the database before downloading anything (eg for testing).
 
+Pass a ContentStore as content_store to keep only one copy of each distinct file: a download with the same hash as a file already stored is replaced with a hardlink to it, or its record points at it.
+
+Pass a ShardedLayout from layout.py as layout to spread the files over subdirectories, eg content/3f/a2/, for collections too big for one directory.
+
+Pass a ResourceRecorder to DownloadResource (download_from_list does this for you) to have the finished records written to the database in batches, rather than saving each record several times during its download.
+
+Each record also stores how long every stage of its download took (time_request, time_download, time_metadata, time_db...), its time to first byte and the bytes transferred, timed with the StageTimer in timing.py.
+
+Functions "lookup_url", "lookup_hash" and "list_duplicates" answer questions about what is already in the database using its indexes, without scanning the whole table.
+
 Function "change_filename" can be run after a resource is downloaded and a DownloadObject has been created. You can use this to change the UUID filename to an alternative of your choosing, including the filename_from_headers or filename_from_url.
+Function "rename_downloads" renames many downloaded files at once to their filename_from_headers or filename_from_url, working out every new name from the database first so clashing names get numbered suffixes, and updates their records in one transaction.
 
 """
 
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-import exiftool # req
-import hashlib
+import itertools
+import http_session
+import job_queue
 import logging
 import ntpath
 import os
 import peewee
+from playhouse.migrate import SqliteMigrator, migrate
+import postprocess
+import rate_limiter as rate_limiter_module
 import re
 import requests # req
+from sniffer import looks_like_html
+from streaming import download_segmented, peek
+import threading
 import time
-from urllib.parse import urlparse, urlunparse
+from timing import StageTimer
+from urllib.parse import unquote, urlparse, urlunparse
 import uuid
 
 logging.basicConfig(level=logging.INFO)
@@ -42,9 +69,9 @@ class Resources(peewee.Model):
 	download_status = peewee.BooleanField(null = True, default = None)
 	message = peewee.CharField(max_length = 300, null = True, default = None)
 	directory = peewee.CharField(max_length = 200, null = True, default = None)
-	url_original = peewee.CharField(max_length = 300)
+	url_original = peewee.CharField(max_length = 300, index = True)
 	url_resolved = peewee.CharField(max_length = 300, null = True, default = None)
-	url_final = peewee.CharField(max_length = 300, null = True, default = None)
+	url_final = peewee.CharField(max_length = 300, null = True, default = None, index = True)
 	datetime = peewee.DateTimeField(null=True, default=None)
 	filename = peewee.CharField(max_length = 100, null=True, default=None)
 	filepath = peewee.CharField(max_length = 300, null=True, default=None)
@@ -52,7 +79,25 @@ class Resources(peewee.Model):
 	filename_from_headers = peewee.CharField(max_length = 100, null=True, default=None)
 	filetype_extension = peewee.CharField(max_length=25, null=True, default=None)
 	mimetype = peewee.CharField(max_length=40, null=True, default=None)
-	md5 = peewee.CharField(max_length=40, null=True, default=None)
+	md5 = peewee.CharField(max_length=40, null=True, default=None, index=True)
+	sha1 = peewee.CharField(max_length=40, null=True, default=None)
+	sha256 = peewee.CharField(max_length=64, null=True, default=None)
+	etag = peewee.CharField(max_length=200, null=True, default=None)
+	last_modified = peewee.CharField(max_length=40, null=True, default=None)
+	previous_id = peewee.IntegerField(null=True, default=None)
+	duplicate = peewee.BooleanField(null=True, default=None)
+	bytes_transferred = peewee.IntegerField(null=True, default=None)
+	ttfb = peewee.FloatField(null=True, default=None)
+	time_wait = peewee.FloatField(null=True, default=None)
+	time_head = peewee.FloatField(null=True, default=None)
+	time_request = peewee.FloatField(null=True, default=None)
+	time_sniff = peewee.FloatField(null=True, default=None)
+	time_download = peewee.FloatField(null=True, default=None)
+	time_hash = peewee.FloatField(null=True, default=None)
+	time_metadata = peewee.FloatField(null=True, default=None)
+	time_rename = peewee.FloatField(null=True, default=None)
+	time_db = peewee.FloatField(null=True, default=None)
+	time_total = peewee.FloatField(null=True, default=None)
 
 	class Meta:
 		database = database
@@ -78,6 +123,8 @@ class DownloadResource:
 		datetime : datetime object
 			The time the resource was requested from url_final
 
+		directory : str
+			Directory holding the downloaded file, including any subdirectories from a layout
 		filename : str
 			Filename of the downloaded file
 		filepath : str
@@ -92,6 +139,23 @@ class DownloadResource:
 			MIMEtype of downloaded file (from EXIFtool)
 		md5 : str
 			md5 hash of downloaded file
+		sha1, sha256 : str
+			sha1 and sha256 hashes of downloaded file, if asked for in hashes
+		etag, last_modified : str
+			'ETag' and 'Last-Modified' validators from the response headers, if sent
+		previous_id : int
+			If the server answered a refresh with 304 Not Modified, the id of the record that first downloaded the file this record points to
+		duplicate : bool
+			True if a ContentStore already held a file with the same hash, so this record links to or points at that file instead of keeping its own copy
+
+		bytes_transferred : int
+			Bytes of the body received over the network, not counting any resumed from an earlier attempt
+		ttfb : float
+			Time to first byte: seconds from sending the request for the body to receiving its headers
+		time_wait, time_head, time_request, time_sniff, time_download, time_hash, time_metadata, time_rename, time_db : float
+			Seconds spent in each stage, or None if the stage didn't run: waiting for the rate limiter, the HEAD request, the GET request(s) up to their headers, reading the first bytes, writing the body to disk, hashing (already included in time_download), recognising the file type or running ExifTool, adding the file extension, and saving the record
+		time_total : float
+			Seconds from the start of the download to the end of the last stage
 
 	METHODS
 	-------
@@ -99,16 +163,23 @@ class DownloadResource:
 	get_real_download_url
 	get_original_filename_from_url
 	get_original_filename_from_request_headers
+	check_for_webpage
 	download_file
 	get_file_metadata
 	add_file_extension
+	final_directory
+	find_previous_download
+	use_previous_file
+	store_content
+	finish
+	record_timings
 
 	Can be run after creation of object to change filename to user preference:
 	change_filename
 		
 	"""
 
-	def __init__(self, url, directory, collect_html, proxies):
+	def __init__(self, url, directory, collect_html, proxies, hashes=("md5",), session=None, use_head=False, recorder=None, refresh=False, retries=3, segments=1, rate_limiter=None, full_metadata=False, post_processor=None, content_store=None, layout=None, host_limiter=None):
 		"""
 		Parameters
 		----------
@@ -120,6 +191,32 @@ class DownloadResource:
 			Set to True if desired behaviour is to download resource if it is just an HTML page. Default is False: download attempt will fail with error message "Target was webpage - deleted"
 		proxies : dict, optional
 			Pass a proxies dictionary if it will be required for requests.
+		hashes : tuple of str, optional
+			Hashes to compute while the file is written, from "md5", "sha1" and "sha256". Default is ("md5",).
+		session : requests.Session, optional
+			Session to make requests through. Default is the pooled session shared by all downloads (see http_session.py).
+		use_head : bool, optional
+			Set to True to resolve redirects with a HEAD request before the GET, for servers that need it. Default is False: a single GET follows the redirects and its response is downloaded directly if no query or fragment had to be cleaned from the URL.
+		recorder : ResourceRecorder, optional
+			If given, the record is only kept in memory during the download and handed to the recorder to write once finished; record.id is set when the recorder flushes. Default is None: the record is saved to the database as each step completes.
+		refresh : bool, optional
+			Set to True to send the 'ETag' and 'Last-Modified' validators saved from the last successful download of this URL. If the server answers 304 Not Modified, the new record points at the existing file instead of downloading it again. Default is False.
+		retries : int, optional
+			Number of times an interrupted download carries on from where it stopped with a Range request, if the server allows it. Default is 3.
+		segments : int, optional
+			Number of byte ranges to download at the same time for large files (32 MB or more with 4 segments), if the server reports a 'Content-Length' and accepts Range requests. Default is 1: files are downloaded in one stream.
+		rate_limiter : rate_limiter.RateLimiter, optional
+			Limiter holding each host to its own request rate. Default is the limiter shared by all downloads, which allows 2 requests per second to each host (see rate_limiter.py).
+		full_metadata : bool, optional
+			Set to True to always run ExifTool and keep everything it reports in self.metadata. Default is False: common file types are recognised from their first bytes and ExifTool is only run on the rest.
+		post_processor : postprocess.PostProcessor, optional
+			If given, the file's metadata is read and the download finished on the post-processor once the file is written, and self.post_processing is a Future that completes when that is done. Default is None: everything is done before the object is returned.
+		content_store : ContentStore, optional
+			If given, a downloaded file whose hash is already in the store is not kept twice: it is replaced with a hardlink to the stored file, or the record points at the stored file (see ContentStore). Default is None: every download keeps its own file.
+		layout : layout.ShardedLayout, optional
+			If given, the finished file is moved into subdirectories of directory named after the start of its UUID or hash, so no one directory holds every file. Default is None: files stay in directory.
+		host_limiter : HostLimiter, optional
+			Limiter whose slot for the host this download already holds. Segments beyond the first are only opened while the host has slots free. download_from_list passes its own. Default is None: segments are not capped.
 		"""
 
 		self.download_status = None
@@ -127,25 +224,81 @@ class DownloadResource:
 		self.directory = directory
 		self.collect_html = collect_html
 		self.proxies = proxies
+		self.hashes = hashes
+		self.session = session if session is not None else http_session.get_session()
+		self.use_head = use_head
+		self.recorder = recorder
+		self.refresh = refresh
+		self.retries = retries
+		self.segments = segments
+		self.rate_limiter = rate_limiter if rate_limiter is not None else rate_limiter_module.get_limiter()
+		self.full_metadata = full_metadata
+		self.post_processor = post_processor
+		self.post_processing = None
+		self.content_store = content_store
+		if content_store is not None and content_store.hash_name not in hashes:
+			raise ValueError(f"content_store uses {content_store.hash_name}, which is not in hashes {hashes}")
+		self.host_limiter = host_limiter
+		self.layout = layout
+		if layout is not None and layout.key == "hash" and layout.hash_name not in hashes:
+			raise ValueError(f"layout uses {layout.hash_name}, which is not in hashes {hashes}")
+		self.prefix = b""
+		self.metadata = None
 		self.url_original = url
 		self.url_final = None
+		self.r = None
+		self.not_modified = False
+		self.bytes_transferred = None
+		self.ttfb = None
+		# monotonic timings of each stage, stored on the record at the end
+		self.timer = StageTimer()
 				
-		# creates an entry in the Resources table and returns it as "self.record"
-		self.record = Resources.create(url_original = self.url_original)
+		if self.recorder is None:
+			# creates an entry in the Resources table and returns it as "self.record"
+			with self.timer.stage("db"):
+				self.record = Resources.create(url_original = self.url_original)
+		else:
+			# the recorder writes the entry once the download is finished
+			self.record = Resources(url_original = self.url_original)
+
+		self.previous = self.find_previous_download() if self.refresh else None
 
 		self.get_real_download_url()
 
+		# nothing to download if the server says our copy is still current
+		if self.not_modified:
+			self.use_previous_file()
 		# continue if no error with requesting URL
-		if self.download_status != False:
+		elif self.download_status != False:
 
 			self.get_original_filename_from_url()
 			self.get_original_filename_from_request_headers()
-			self.download_file()
-			self.get_file_metadata()
+			self.check_for_webpage()
+			if self.download_status != False:
+				self.download_file()
+			if self.download_status == True:
+				if self.post_processor is not None:
+					# the rest happens once the post-processor has read the metadata
+					self.post_processing = self.post_processor.submit(self)
+					return
+				self.get_file_metadata()
+
+		self.finish()
+
+		
+# ***METHODS***
 
+	def finish(self):
+		"""Adds the file extension, logs the outcome, records the timings and hands the record to the recorder if there is one. Run at the end of __init__, or by the post-processor once it has read the metadata.
+		"""
 		# check file extension is correct if file downloaded and not deleted by collect_html flag setting
 		if self.download_status == True:
-			self.add_file_extension()
+			if self.not_modified:
+				pass
+			elif self.content_store is not None:
+				self.store_content()
+			else:
+				self.add_file_extension()
 
 		# log outcome
 			if self.mimetype == None:
@@ -163,21 +316,43 @@ class DownloadResource:
 		# this is here in case something somehow makes it through without changing download_status to True or False
 		else:
 			logging.warning(f"{self.url_original} NO STATUS SET.")
-			
-		time.sleep(.5)
 
-		
-# ***METHODS***
+		self.record_timings()
+		if self.recorder is not None:
+			self.recorder.add(self.record)
+
+	def _save_record(self):
+		"""Saves the record straight away unless a recorder will write it at the end
+		"""
+		if self.recorder is None:
+			with self.timer.stage("db"):
+				self.record.save()
+
+	def record_timings(self):
+		"""Copies the stage timings, time to first byte and bytes transferred to the record, and saves it unless a recorder will write it.
+		The time of this last save is not included in time_db.
+		"""
+		self.timer.finish()
+		for field, seconds in self.timer.as_fields().items():
+			setattr(self.record, field, seconds)
+		self.record.ttfb = self.ttfb
+		self.record.bytes_transferred = self.bytes_transferred
+		if self.recorder is None:
+			self.record.save()
 
 	def get_real_download_url(self):
 		"""Cleans any spaces and trailing slashes from the given URL, resolves any redirects and removes any parameters, queries or fragments from end of URL to find final URL to request resource from. Logs error if unable to retrieve URL.
 		"""
 
 		url_stripped = self.url_original.strip().rstrip("/")
+		headers = self.conditional_headers()
 		# check if the URL redirects
-		session = requests.Session()
 		try:
-			response = session.head(url_stripped, allow_redirects=True, proxies=self.proxies)
+			if self.use_head:
+				response = self._request("head", url_stripped, allow_redirects=True, proxies=self.proxies)
+			else:
+				# one streamed GET follows the redirects - its body is only read if it is already the final URL
+				response = self._request("get", url_stripped, allow_redirects=True, timeout=(5,14), proxies=self.proxies, headers=headers, stream=True)
 			self.record.url_resolved = response.url
 			
 #***	EXPERIMENTAL: clean any parameter, query or fragment attributes from end of URL. IS THIS GOING TO MAKE ANYTHING FALL OVER?!
@@ -187,14 +362,23 @@ class DownloadResource:
 			self.url_final = urlunparse(path_url_tuple)
 			self.record.url_final = urlunparse(path_url_tuple)
 		
-			# get the thing, recording the time
-			self.record.datetime = datetime.now()
-			
-			self.r = requests.get(self.url_final, timeout=(5,14), proxies=self.proxies)
+			if not self.use_head and response.url == self.url_final:
+				self.r = response
+			else:
+				if not self.use_head:
+					response.close()
+				# get the thing, streaming the body so download_file can write it to disk without holding it all in memory
+				self.r = self._request("get", self.url_final, timeout=(5,14), proxies=self.proxies, headers=headers, stream=True)
+			# with stream=True, elapsed runs from sending the request to parsing the headers
+			self.ttfb = self.r.elapsed.total_seconds()
 			self.r.raise_for_status()
+			self.not_modified = self.r.status_code == 304 and self.previous is not None
+			self.record.etag = self.r.headers.get('ETag')
+			self.record.last_modified = self.r.headers.get('Last-Modified')
 		except requests.exceptions.HTTPError as e:
 			self.download_status = False
 			self.message = f"HTTPError: {self.r.status_code}"
+			self.r.close()
 		except requests.exceptions.ConnectionError as e:
 			print (e)
 			self.download_status = False
@@ -205,13 +389,81 @@ class DownloadResource:
 
 		self.record.download_status = self.download_status
 		self.record.message = self.message
-		self.record.save()
+		self._save_record()
+
+	def _request(self, method, url, **kwargs):
+		"""Makes a GET or HEAD request once the rate limiter allows it, recording the time of a GET. If the host answers 429 or 503 with a 'Retry-After' header, the request is made again once that pause is over, up to the limiter's retries times.
+		"""
+		for attempt in range(self.rate_limiter.retries + 1):
+			with self.timer.stage("wait"):
+				self.rate_limiter.wait(url)
+				if attempt and urlparse(response.url).netloc != urlparse(url).netloc:
+					# the host that asked for the pause was at the end of a redirect
+					self.rate_limiter.wait(response.url)
+			if method == "get":
+				self.record.datetime = datetime.now()
+			with self.timer.stage("request" if method == "get" else "head"):
+				response = getattr(self.session, method)(url, **kwargs)
+			if self.rate_limiter.check_response(response) is None or attempt == self.rate_limiter.retries:
+				return response
+			response.close()
+			logging.info(f"{url} answered {response.status_code} - asking again once the pause is over")
+
+	def find_previous_download(self):
+		"""Returns the most recent successful record for this URL that saved an 'ETag' or 'Last-Modified' validator and whose file is still on disk, or None if there isn't one.
+		Records whose file has gone are passed over, so the file is downloaded again rather than a "not modified" record pointing at nothing.
+		"""
+		query = (Resources
+			.select()
+			.where(
+				(Resources.url_original == self.url_original)
+				& (Resources.download_status == True)
+				& (Resources.filepath.is_null(False))
+				& (Resources.etag.is_null(False) | Resources.last_modified.is_null(False)))
+			.order_by(Resources.id.desc()))
+		for previous in query.iterator():
+			if os.path.isfile(previous.filepath):
+				return previous
+		return None
+
+	def conditional_headers(self):
+		"""Makes the 'If-None-Match' and 'If-Modified-Since' request headers from the previous download's validators, if refreshing
+		"""
+		headers = {}
+		if self.previous is not None:
+			if self.previous.etag is not None:
+				headers['If-None-Match'] = self.previous.etag
+			if self.previous.last_modified is not None:
+				headers['If-Modified-Since'] = self.previous.last_modified
+		return headers
+
+	def use_previous_file(self):
+		"""Records a 304 Not Modified response by pointing this record at the file from the previous download, without writing, hashing or reading metadata again
+		"""
+		self.r.close()
+		previous = self.previous
+		# point at the record that actually downloaded the file, not at an earlier "not modified" record
+		original_id = previous.previous_id or previous.id
+		self.download_status = True
+		self.message = f"Not modified - file is from record {original_id}"
+		self.directory, self.filename, self.filepath = previous.directory, previous.filename, previous.filepath
+		self.filetype_extension, self.mimetype = previous.filetype_extension, previous.mimetype
+
+		for field in ('directory', 'filename', 'filepath', 'filename_from_url', 'filename_from_headers', 'filetype_extension', 'mimetype', 'md5', 'sha1', 'sha256'):
+			setattr(self.record, field, getattr(previous, field))
+		# a 304 doesn't have to repeat the validators
+		self.record.etag = self.record.etag or previous.etag
+		self.record.last_modified = self.record.last_modified or previous.last_modified
+		self.record.previous_id = original_id
+		self.record.download_status = self.download_status
+		self.record.message = self.message
+		self._save_record()
 
 	def get_original_filename_from_url(self):
 		"""grabs the bit of the url after the last "/"
 		"""
 		self.record.filename_from_url = os.path.split(self.url_final)[-1]
-		self.record.save()
+		self._save_record()
 
 	def get_original_filename_from_request_headers(self):
 		"""Uses a regex to find the filename in URL headers['Content-Disposition'] if it exists
@@ -225,34 +477,69 @@ class DownloadResource:
 			else:
 				self.message = "'Content-Disposition' exists in headers but failed to parse filename"
 				self.record.message = self.message
-			self.record.save()
+			self._save_record()
+
+	def check_for_webpage(self):
+		"""Reads the first few KB of the response, which get_file_metadata also uses to recognise the file type.
+		If HTML pages aren't wanted, judges from the 'Content-Type' and those bytes whether it is a web page, and if so drops it before anything is written to disk
+		"""
+		with self.timer.stage("sniff"):
+			self.prefix = peek(self.r)
+		if self.collect_html == True:
+			return
+		if looks_like_html(self.r.headers.get('Content-Type'), self.prefix):
+			# closing without reading the rest of the body aborts the transfer
+			self.r.close()
+			self.bytes_transferred = len(self.prefix)
+			self.download_status = False
+			self.message = "Target was webpage - deleted"
+			self.record.download_status = self.download_status
+			self.record.directory = None
+			self.record.message = self.message
+			self._save_record()
 
 	def download_file(self):
-		"""Downloads the resource, minting a unique filename from a UUID and creating the destination directory first if necessary
+		"""Downloads the resource, minting a unique filename from a UUID and creating the destination directory first if necessary.
+		The file is hashed as it is written, so it never has to be read back from disk. Large files can be split into segments downloaded in parallel. An interrupted download is resumed if the server allows it, otherwise a ".part" file is kept in the directory for the next attempt.
 		"""
 
-		if not os.path.exists(self.directory): os.makedirs(self.directory)
+		os.makedirs(self.directory, exist_ok=True)
 		self.filename = str(uuid.uuid4())
 		self.filepath = os.path.join(self.directory, self.filename)
 
-		with open(self.filepath, 'wb') as f:
-			for chunk in self.r.iter_content(100000):
-				f.write(chunk)
+		try:
+			# with one segment this is a plain resumable download
+			with self.timer.stage("download"):
+				writer = download_segmented(self.session, self.r, self.filepath, self.hashes, segments=self.segments, retries=self.retries, rate_limiter=self.rate_limiter, host_limiter=self.host_limiter, timeout=(5,14), proxies=self.proxies)
+		except (requests.exceptions.RequestException, OSError) as e:
+			self.download_status = False
+			# a file that can't be written or moved into place fails this download only
+			self.message = f"Download interrupted: {e}" if isinstance(e, requests.exceptions.RequestException) else f"Could not save file: {e}"
+			self.filename, self.filepath = None, None
+			self.record.download_status = self.download_status
+			self.record.message = self.message
+			self._save_record()
+			return
+		self.digests = writer.hexdigests()
+		self.timer.add("hash", writer.hash_seconds)
+		self.bytes_transferred = writer.bytes_downloaded
 		self.download_status = True
 
 		self.record.download_status = self.download_status
 		self.record.filename = self.filename
 		self.record.directory = self.directory
 		self.record.filepath = self.filepath
-		self.record.save()
+		self._save_record()
 
-	def get_file_metadata(self):
-		"""Uses EXIFtool to get file extension and MIMEtype, then gets md5 hash
+	def get_file_metadata(self, metadata=None):
+		"""Gets file extension and MIMEtype, then records the hashes taken during download_file.
+		Common file types are recognised from their first bytes; EXIFtool is only run on anything else, or on everything if full_metadata was set. A post-processor passes in the metadata it has already read.
 		"""
 
-#***	# TODO: put exiftool.exe somewhere where it doesn't need the full path
-		with exiftool.ExifTool() as et:
-			metadata = et.get_metadata(self.filepath)
+		if metadata is None:
+			with self.timer.stage("metadata"):
+				metadata = postprocess.read_metadata(self.filepath, self.prefix, self.full_metadata)
+		self.metadata = metadata
 
 		# if discarding html pages, this happens here
 		if self.collect_html == False:
@@ -267,14 +554,14 @@ class DownloadResource:
 					self.record.directory, self.record.filename, self.record.filepath = None, None, None
 					self.record.download_status = self.download_status
 					self.record.message = self.message
-					self.record.save()					
+					self._save_record()
 					return
 
 		if 'ExifTool:Error' in metadata:
 			if self.message == None:
 				self.message = "Unknown filetype"
 			else:
-				self.message = f"{message} ; Unknown filetype"
+				self.message = f"{self.message} ; Unknown filetype"
 
 			self.record.message = self.message
 			
@@ -287,62 +574,586 @@ class DownloadResource:
 		else:
 			self.mimetype = None
 
-			self.record.filetype_extension = self.filetype_extension
-			self.record.mimetype = self.mimetype
+		self.record.filetype_extension = self.filetype_extension
+		self.record.mimetype = self.mimetype
 
-		hash_md5 = hashlib.md5()
-		with open(self.filepath, "rb") as f:
-			for chunk in iter(lambda: f.read(4096), b""):
-				hash_md5.update(chunk)
-		self.record.md5 = hash_md5.hexdigest()
+		self.record.md5 = self.digests.get("md5")
+		self.record.sha1 = self.digests.get("sha1")
+		self.record.sha256 = self.digests.get("sha256")
 
-		self.record.save()
+		self._save_record()
 
 	def add_file_extension(self):
-		"""Adds correct file extension as found by EXIFtool to filename 
+		"""Adds correct file extension as found by EXIFtool to filename, and moves the file into its subdirectory if there is a layout
 		"""
+		new_directory = self.final_directory()
+		new_filename = self.filename
 		if self.filetype_extension != None:
-			new_filepath = os.path.join(self.directory, self.filename + os.extsep + self.filetype_extension.lower())
-			os.rename(self.filepath, new_filepath)
-			self.record.filepath = new_filepath
-			self.record.filename = str(ntpath.basename(self.filepath))
+			new_filename = self.filename + os.extsep + self.filetype_extension.lower()
+		if (new_directory, new_filename) != (self.directory, self.filename):
+			new_filepath = os.path.join(new_directory, new_filename)
+			with self.timer.stage("rename"):
+				if new_directory != self.directory:
+					os.makedirs(new_directory, exist_ok=True)
+				os.rename(self.filepath, new_filepath)
+			self.directory = new_directory
+			self.filepath = new_filepath
+			self.filename = str(ntpath.basename(new_filepath))
+			self.record.directory = self.directory
+			self.record.filepath = self.filepath
+			self.record.filename = self.filename
 
-			self.record.save()
+			self._save_record()
+
+	def final_directory(self):
+		"""Returns the directory the finished file belongs in: its subdirectory if there is a layout, else the directory it was downloaded to
+		"""
+		if self.layout is None:
+			return self.directory
+		return self.layout.place(self.directory, self.filename, self.digests)
+
+	def store_content(self):
+		"""Adds the downloaded file to the content store, or drops it if the store already has the same content.
+		A file new to the store gets its extension and becomes the stored copy of its hash. A duplicate - same hash and size - is replaced with a hardlink to the stored copy, or deleted with the record pointing at the stored copy, depending on the store's mode.
+		"""
+		store = self.content_store
+		digest = self.digests[store.hash_name]
+		size = os.path.getsize(self.filepath)
+		with store.claim(digest, size, self.filepath) as stored_path:
+			linked_path = None
+			if stored_path is not None:
+				with self.timer.stage("rename"):
+					linked_path = store.link(stored_path, self.filepath, self.final_directory())
+			if linked_path is None:
+				# the lock is held until the file has its final name, so another copy can't link to the old one
+				self.add_file_extension()
+				store.add(digest, self.filepath, size)
+				return
+		self.filepath = linked_path
+		self.directory, self.filename = os.path.split(self.filepath)
+		# "Duplicate: " keeps the message type the same for every duplicate, whatever the path (see run_metrics)
+		self.message = f"Duplicate: {stored_path}" if self.message is None else f"{self.message} ; Duplicate: {stored_path}"
+
+		self.record.directory = self.directory
+		self.record.filename = self.filename
+		self.record.filepath = self.filepath
+		self.record.duplicate = True
+		self.record.message = self.message
+		self._save_record()
+
+class ResourceRecorder:
+	"""Collects finished Resources records in memory and writes them to the database in batches, one transaction per batch.
+	Can be used as a context manager, which flushes anything left over on exit.
+	...
+	Parameters
+	----------
+	batch_size : int, optional
+		Number of records to collect before writing them all in one transaction. Default is 500.
+	queue : job_queue.JobQueue, optional
+		Queue whose jobs the records belong to. Each job is marked finished in the same transaction that saves its record, so a crash can't leave a job marked done without its record. Default is None.
+
+	METHODS
+	-------
+
+	add
+	for_job
+	flush
+	"""
+
+	def __init__(self, batch_size=500, queue=None):
+		self.batch_size = batch_size
+		self.queue = queue
+		self._pending = []
+		self._lock = threading.Lock()
+
+	def add(self, record, job=None):
+		"""Queues a finished record, and the queue job it belongs to if any, writing the batch if it is now full
+		"""
+		with self._lock:
+			self._pending.append((record, job))
+			batch_full = len(self._pending) >= self.batch_size
+		if batch_full:
+			self.flush()
+
+	def for_job(self, job):
+		"""Returns a recorder to pass to the DownloadResource for a queue job, which adds its record to this one tagged with the job
+		"""
+		return _JobRecorder(self, job)
+
+	def flush(self):
+		"""Writes all queued records in a single transaction, giving each its database id, and returns them
+		"""
+		# holding the lock while writing keeps this the only thread writing through the recorder
+		with self._lock:
+			pending, self._pending = self._pending, []
+			if pending:
+				with database.atomic():
+					for record, _ in pending:
+						record.save()
+					if self.queue is not None:
+						self.queue.finish_many([(job, record) for record, job in pending if job is not None])
+		return [record for record, _ in pending]
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.flush()
+
+class _JobRecorder:
+	"""Stands in for a ResourceRecorder in a DownloadResource working on a queue job, passing its record on tagged with the job
+	"""
+
+	def __init__(self, recorder, job):
+		self.recorder = recorder
+		self.job = job
+
+	def add(self, record):
+		self.recorder.add(record, self.job)
+
+class ContentStore:
+	"""Keeps one copy of each distinct file downloaded, keyed by its hash, for DownloadResource and download_from_list.
+	A download whose hash and size match a file already stored - by this store or in an earlier run, as found in the database - is not kept twice. Matching hashes with different sizes are logged as a hash clash and both files are kept.
+	...
+	Parameters
+	----------
+	mode : str, optional
+		"hardlink" to replace a duplicate with a hardlink to the stored file, so every record still has its own filename in its own directory but the content is on disk once. Falls back to "reference" where hardlinks can't be made, eg across drives. "reference" to delete the duplicate and point its record's filepath at the stored file. Default is "hardlink".
+	hash_name : str, optional
+		Hash to key the store by, from "md5", "sha1" and "sha256". Must be one of the hashes being computed. Default is "md5", which is indexed in the database.
+	cache_size : int, optional
+		Number of recently stored hashes kept in memory. Older ones are looked up in the database. Should be more than the records waiting in a ResourceRecorder. Default is 100000.
+
+	METHODS
+	-------
+
+	claim
+	add
+	link
+	"""
 
-def download_from_list(urls, directory="content", collect_html=False, proxies=None):
-	"""Run DownloadResource over a list of URLs, downloading resources and returning a list of dictionaries of URLs and their database IDs.
+	def __init__(self, mode="hardlink", hash_name="md5", cache_size=100000):
+		if mode not in ("hardlink", "reference"):
+			raise ValueError(f"Unknown content store mode '{mode}'")
+		if hash_name not in ("md5", "sha1", "sha256"):
+			raise ValueError(f"Unknown hash '{hash_name}'")
+		self.mode = mode
+		self.hash_name = hash_name
+		self.cache_size = cache_size
+		self.started = datetime.now()
+		# hash -> (filepath, size) of files stored during this run, whose records may not be written yet
+		self._stored = OrderedDict()
+		self._lock = threading.Lock()
+
+	@contextmanager
+	def claim(self, digest, size, filepath):
+		"""Holds the store while the downloaded file at filepath is checked against it, yielding the path of the stored file with this hash and size, or None if there isn't one still on disk.
+		The caller should link to the stored file, or add its own file if there is none, inside the with block, so two copies of the same content can't both be stored.
+		"""
+		with self._lock:
+			stored = self._stored.get(digest)
+			if stored is not None and not os.path.isfile(stored[0]):
+				# the stored file has been deleted or renamed since, eg by rename_downloads - its record says where it is now, if anywhere
+				del self._stored[digest]
+				stored = None
+			if stored is None:
+				stored = self._find_stored(digest, filepath)
+			if stored is not None and stored[1] != size:
+				logging.warning(f"Hash clash: {self.hash_name} {digest} is {stored[1]} bytes in '{stored[0]}' but {size} bytes in the new download - keeping both")
+				stored = None
+			yield stored[0] if stored is not None else None
+
+	def _find_stored(self, digest, filepath):
+		"""Returns (filepath, size) of a file still on disk from an earlier download with this hash, or None. The download's own record, if already saved, is left out.
+		"""
+		column = getattr(Resources, self.hash_name)
+		# a record from this run without time_total is still being downloaded, and its file may yet be renamed
+		finished = Resources.time_total.is_null(False) | (Resources.datetime < self.started)
+		query = (Resources
+			.select(Resources.filepath)
+			.where((column == digest) & (Resources.download_status == True) & Resources.filepath.is_null(False) & finished)
+			.order_by(Resources.id)
+			.tuples())
+		for (stored_path,) in query.iterator():
+			if stored_path != filepath and os.path.isfile(stored_path):
+				return stored_path, os.path.getsize(stored_path)
+		return None
+
+	def add(self, digest, filepath, size):
+		"""Makes filepath the stored copy for its hash. Call inside claim.
+		"""
+		self._stored[digest] = (filepath, size)
+		self._stored.move_to_end(digest)
+		if len(self._stored) > self.cache_size:
+			self._stored.popitem(last=False)
+
+	def link(self, stored_path, filepath, directory=None):
+		"""Replaces the duplicate at filepath and returns the path its record should point at: a hardlink to stored_path with the duplicate's filename and the stored file's extension, made in directory if given, or stored_path itself. Call inside claim.
+		The duplicate is only deleted once the hardlink is in place. If the stored file has gone, the duplicate is kept and None is returned.
+		"""
+		if self.mode == "hardlink":
+			directory = directory if directory is not None else os.path.dirname(filepath)
+			linked_path = os.path.join(directory, os.path.basename(filepath) + os.path.splitext(stored_path)[1])
+			# made under a temporary name first, so a failed link never leaves a half-finished file at linked_path
+			temporary_path = linked_path + ".link"
+			try:
+				os.makedirs(directory, exist_ok=True)
+				os.link(stored_path, temporary_path)
+				os.replace(temporary_path, linked_path)
+			except OSError as e:
+				logging.warning(f"Could not hardlink '{linked_path}' to '{stored_path}' ({e}) - pointing at the stored file instead")
+				if os.path.exists(temporary_path):
+					os.remove(temporary_path)
+			else:
+				if linked_path != filepath:
+					os.remove(filepath)
+				return linked_path
+		if not os.path.isfile(stored_path):
+			logging.warning(f"Stored file '{stored_path}' has gone - keeping '{filepath}' instead")
+			return None
+		os.remove(filepath)
+		return stored_path
+
+class HostLimiter:
+	"""Caps the number of downloads running against any single host at the same time, so concurrent batches do not hammer one origin.
+	...
+	Parameters
+	----------
+	max_per_host : int
+		Maximum number of simultaneous downloads allowed from the same host. A download split into segments uses a slot for each segment.
+
+	METHODS
+	-------
+
+	slot
+	extra_slots
+	"""
+
+	def __init__(self, max_per_host):
+		self.max_per_host = max_per_host
+		self._lock = threading.Lock()
+		self._semaphores = {}
+
+	def _semaphore_for(self, url):
+		host = urlparse(url.strip()).netloc.lower()
+		with self._lock:
+			if host not in self._semaphores:
+				self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+			return self._semaphores[host]
+
+	@contextmanager
+	def slot(self, url):
+		"""Blocks until a download slot is free for the host of the given URL, and holds it for the duration of the with block
+		"""
+		with self._semaphore_for(url):
+			yield
+
+	@contextmanager
+	def extra_slots(self, url, count):
+		"""Takes up to count more slots for the host of the given URL without waiting, for a download that already holds one and wants more connections, eg for segments. Yields the number taken and holds them for the duration of the with block.
+		"""
+		semaphore = self._semaphore_for(url)
+		taken = 0
+		# never waits, so downloads each holding a slot can't block one another
+		while taken < count and semaphore.acquire(blocking=False):
+			taken += 1
+		try:
+			yield taken
+		finally:
+			for _ in range(taken):
+				semaphore.release()
+
+def _ensure_database():
+	"""Starts the default database if the user hasn't already started one
+	"""
+	if database.deferred:
+		logging.warning("No database started - will add download to default database 'files_from_urls.db'. You can change this behaviour by calling 'downloader.start_database'.")
+		start_database()
+
+def _resource_summary(resource):
+	"""Makes the dictionary of original url and id returned for each resource
+	"""
+	return {
+	'url_original' : resource.record.url_original,
+	'id' : resource.record.id}
+
+def _download_tracked(url, directory, collect_html, proxies, options, metrics):
+	"""Runs DownloadResource, telling metrics (a run_metrics.RunMetrics) when the download starts and finishes if given
+	"""
+	if metrics is None:
+		return DownloadResource(url, directory, collect_html, proxies, **options)
+	metrics.started(url)
+	try:
+		resource = DownloadResource(url, directory, collect_html, proxies, **options)
+	except Exception as e:
+		metrics.finished(url, False, f"{type(e).__name__}: {e}")
+		raise
+	if resource.post_processing is None:
+		metrics.record(resource)
+	else:
+		# counted once the post-processor has finished it
+		def record(future):
+			if future.exception() is not None:
+				metrics.finished(url, False, f"{type(future.exception()).__name__}: {future.exception()}")
+			else:
+				metrics.record(resource)
+		resource.post_processing.add_done_callback(record)
+	return resource
+
+def _download_within_limit(limiter, url, directory, collect_html, proxies, options, metrics):
+	"""Runs DownloadResource once the host of the URL has a free slot in the limiter
+	"""
+	with limiter.slot(url):
+		return _download_tracked(url, directory, collect_html, proxies, options, metrics)
+
+def known_record_id(url):
+	"""Returns the id of the most recent successful record for a URL, as an original or final URL, or None if it hasn't been downloaded. Uses the URL indexes, so it doesn't scan the table.
+	"""
+	url_stripped = url.strip().rstrip("/")
+	query = (Resources
+		.select(Resources.id)
+		.where(((Resources.url_original == url) | (Resources.url_final == url_stripped)) & (Resources.download_status == True))
+		.order_by(Resources.id.desc())
+		.limit(1)
+		.tuples())
+	row = query.first()
+	return row[0] if row is not None else None
+
+def read_urls(source):
+	"""Yields URLs one at a time, reading as it goes.
+	...
+	Parameters
+	----------
+	source : iterable of str, or str / path
+		Any iterable of URLs, eg a list, a generator or a database cursor. A str or path is read as a text file with one URL per line; blank lines and lines starting with "#" are left out.
+	"""
+	if isinstance(source, (str, os.PathLike)):
+		with open(source, encoding="utf-8") as f:
+			for line in f:
+				url = line.strip()
+				if url and not url.startswith("#"):
+					yield url
+	else:
+		yield from source
+
+# a finished download waits at most this long, in seconds, for the recorder to write its record before iter_download_from_list writes it early
+RESULT_FLUSH_SECONDS = 5
+# lease on each job of a job_batch, in seconds. Renewed while the run is alive, so the jobs of a run that dies are handed out again this soon.
+JOB_LEASE_SECONDS = 60
+
+def _download_items(items, directory, collect_html, proxies, options, recorder, metrics, max_workers, max_per_host, lookahead):
+	"""Downloads (position, url, job, existing_id) items as they are read, holding no more than lookahead of them at once.
+	Yields (item, resource) as each finishes, including any post-processing; items with an existing_id are passed straight through with resource None. With several workers or a post-processor, also yields None whenever RESULT_FLUSH_SECONDS pass with nothing finishing, so the caller can write waiting records.
+	"""
+	limiter = HostLimiter(max_per_host) if max_workers > 1 else None
+	post_processor = options.get("post_processor")
+
+	def download(url, job):
+		item_options = dict(options, recorder=recorder.for_job(job) if recorder is not None and job is not None else recorder, host_limiter=limiter)
+		if limiter is not None:
+			return _download_within_limit(limiter, url, directory, collect_html, proxies, item_options, metrics)
+		return _download_tracked(url, directory, collect_html, proxies, item_options, metrics)
+
+	if max_workers <= 1 and post_processor is None:
+		for item in items:
+			position, url, job, existing_id = item
+			yield item, (download(url, job) if existing_id is None else None)
+		return
+
+	items = iter(items)
+	running = {}
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		try:
+			while True:
+				# top up from the input only as far as lookahead, so a long input is never read all at once
+				while len(running) < lookahead:
+					item = next(items, None)
+					if item is None:
+						break
+					position, url, job, existing_id = item
+					if existing_id is not None:
+						yield item, None
+					else:
+						running[executor.submit(download, url, job)] = item
+				if not running:
+					return
+				finished, _ = wait(running, timeout=RESULT_FLUSH_SECONDS, return_when=FIRST_COMPLETED)
+				if not finished:
+					yield None
+				for future in finished:
+					item = running.pop(future)
+					resource = future.result()
+					if resource.post_processing is not None and resource.post_processing is not future:
+						# downloaded, but still being post-processed - wait for that instead
+						running[resource.post_processing] = item
+						continue
+					yield item, resource
+		finally:
+			# stops downloads that haven't started if the caller gives up early or something goes wrong
+			for future in running:
+				future.cancel()
+
+def _iter_results(urls, directory, collect_html, proxies, max_workers, max_per_host, hashes, session, use_head, record_batch_size, skip_known, refresh, retries, segments, rate_limiter, full_metadata, metrics, job_batch, max_attempts, lookahead, post_processor, content_store, layout, prompt=False):
+	"""Runs the downloads for download_from_list and iter_download_from_list, yielding (position, result dictionary) as each record is written.
+	With prompt, downloads made one at a time have their records written as each finishes, since the next download would hold them back for as long as it takes.
+	"""
+	_ensure_database()
+	# settings passed on to every DownloadResource
+	options = {"hashes": hashes, "session": session, "use_head": use_head, "refresh": refresh, "retries": retries, "segments": segments, "rate_limiter": rate_limiter, "full_metadata": full_metadata, "post_processor": post_processor, "content_store": content_store, "layout": layout}
+	if not lookahead:
+		# room for every worker to have a download waiting, plus everything the post-processor can hold
+		lookahead = max_workers * 2 + (post_processor.queue_size if post_processor is not None else 0)
+	queue = None
+	owner = None
+	if job_batch is None:
+		recorder = ResourceRecorder(record_batch_size) if record_batch_size else None
+
+		def items():
+			for position, url in enumerate(read_urls(urls)):
+				existing_id = known_record_id(url) if skip_known else None
+				if metrics is not None:
+					metrics.skipped(1) if existing_id is not None else metrics.expect(1)
+				yield position, url, None, existing_id
+	else:
+		queue = job_queue.JobQueue(database, job_batch, lease_seconds=JOB_LEASE_SECONDS, max_attempts=max_attempts)
+		queue.enqueue(read_urls(urls), lookup_existing=known_record_id if skip_known else None)
+		counts = queue.counts()
+		to_do = counts.get(job_queue.PENDING, 0) + counts.get(job_queue.IN_PROGRESS, 0)
+		logging.info(f"Job batch '{job_batch}': {counts.get(job_queue.DONE, 0)} done, {counts.get(job_queue.FAILED, 0)} failed, {to_do} to do")
+		if metrics is not None:
+			metrics.expect(to_do)
+			metrics.skipped(counts.get(job_queue.DONE, 0) + counts.get(job_queue.FAILED, 0))
+		recorder = ResourceRecorder(record_batch_size, queue=queue) if record_batch_size else None
+		owner = job_queue.new_owner_name()
+
+		def items():
+			# jobs are claimed only as workers become free, so other processes can share the batch
+			while True:
+				jobs = queue.claim(owner)
+				if not jobs:
+					return
+				yield jobs[0].position, jobs[0].url, jobs[0], None
+
+	# one download at a time: nothing else finishes while the next one runs
+	serial_prompt = prompt and max_workers <= 1 and post_processor is None
+	# finished resources whose records the recorder hasn't written yet, oldest first
+	waiting = deque()
+	try:
+		with queue.keep_leases(owner) if queue is not None else nullcontext():
+			while True:
+				for event in _download_items(items(), directory, collect_html, proxies, options, recorder, metrics, max_workers, max_per_host, lookahead):
+					if event is not None:
+						(position, url, job, existing_id), resource = event
+						if resource is None:
+							yield position, {'url_original' : url, 'id' : existing_id}
+						else:
+							# without a recorder the record is already saved, so its job can be finished straight away
+							if job is not None and recorder is None:
+								queue.finish(job, resource.record)
+							waiting.append((position, resource, time.monotonic()))
+					if waiting and recorder is not None and (serial_prompt or time.monotonic() - waiting[0][2] >= RESULT_FLUSH_SECONDS):
+						recorder.flush()
+					# the recorder writes records in the order they were added, so results come out oldest first
+					while waiting and waiting[0][1].record.id is not None:
+						position, resource, _ = waiting.popleft()
+						yield position, _resource_summary(resource)
+				if queue is None:
+					break
+				# finish this run's jobs before waiting on other runs, which may be waiting on these
+				if recorder is not None:
+					recorder.flush()
+				while waiting:
+					position, resource, _ = waiting.popleft()
+					yield position, _resource_summary(resource)
+				# jobs still held by other runs are taken over if those runs die and stop renewing their leases
+				if not queue.wait_for_others(owner):
+					break
+	finally:
+		# write what has finished and hand back any jobs half done, so a rerun picks them up straight away
+		if recorder is not None:
+			recorder.flush()
+		if queue is not None:
+			queue.release(owner)
+	for position, resource, _ in waiting:
+		yield position, _resource_summary(resource)
+
+def download_from_list(urls, directory="content", collect_html=False, proxies=None, max_workers=1, max_per_host=2, hashes=("md5",), session=None, use_head=False, record_batch_size=500, skip_known=False, refresh=False, retries=3, segments=1, rate_limiter=None, full_metadata=False, metrics=None, job_batch=None, max_attempts=3, lookahead=None, post_processor=None, content_store=None, layout=None):
+	"""Run DownloadResource over a list of URLs, downloading resources and returning a list of dictionaries of URLs and their database IDs, in the order the URLs were given.
+	The URLs are read as they are needed, so they can come from a generator, a database cursor or a file of any size; see iter_download_from_list to also get the results as they finish instead of all at the end.
 	If you haven't already started a database it will use the default behaviour of using "files_from_urls.db" in current directory as the database, and adding new files if that db already exists, not resetting it.
 	...
 	Parameters
 	----------
-	urls : data structure (list, tuple, or set) 
-		Contains the URLs of resources to be downloaded
+	urls : iterable of str, or str / path
+		URLs of the resources to be downloaded, eg a list, a generator or a database cursor. A str or path is read as a text file with one URL per line (see read_urls).
 	directory : str, optional. Defaults to /content.
 		Location of destination directory
 	collect_html : bool, optional
 		Set to True if desired behaviour is to download resource if it is just an HTML page. Default is False: download attempt will fail with error message "Target was webpage - deleted"
 	proxies : dict, optional
 		Pass a proxies dictionary if it will be required for requests.
+	max_workers : int, optional
+		Number of resources to download at the same time. Default is 1, which downloads the URLs one after another.
+	max_per_host : int, optional
+		Only used when max_workers is more than 1. Maximum number of resources downloaded from the same host at the same time. Default is 2.
+	hashes : tuple of str, optional
+		Hashes to compute while each file is written, from "md5", "sha1" and "sha256". Default is ("md5",).
+	session : requests.Session, optional
+		Session to make requests through. Default is the pooled session shared by all downloads (see http_session.py).
+	use_head : bool, optional
+		Set to True to resolve redirects with a HEAD request before the GET, for servers that need it. Default is False.
+	record_batch_size : int, optional
+		Number of finished records written to the database per transaction. Default is 500. Set to 0 to save each record as its download goes, as DownloadResource does on its own.
+	skip_known : bool, optional
+		Set to True to skip URLs that have already been downloaded successfully to this database, as an original or final URL. Skipped URLs are not requested again and are returned with the id of their existing record. Each URL is looked up with known_record_id as it is read. Default is False.
+	refresh : bool, optional
+		Set to True to re-request URLs with the 'ETag' and 'Last-Modified' validators from their last download, so unchanged files are recorded as "not modified" instead of being downloaded again. Has no effect on URLs skipped by skip_known. Default is False.
+	retries : int, optional
+		Number of times an interrupted download carries on from where it stopped with a Range request, if the server allows it. Default is 3.
+	segments : int, optional
+		Number of byte ranges to download at the same time for large files, if the server reports a 'Content-Length' and accepts Range requests. With max_workers more than 1, each segment takes one of its host's max_per_host slots, and only as many segments are opened as there are slots free. Default is 1.
+	rate_limiter : rate_limiter.RateLimiter, optional
+		Limiter holding each host to its own request rate. Default is the limiter shared by all downloads, which allows 2 requests per second to each host (see rate_limiter.py).
+	full_metadata : bool, optional
+		Set to True to always run ExifTool. Default is False: common file types are recognised from their first bytes and ExifTool is only run on the rest.
+	metrics : run_metrics.RunMetrics, optional
+		Counts in-flight, finished and failed downloads, bytes and latencies as the run goes, to be served over HTTP, written to a Prometheus text file or logged as a progress line (see run_metrics.py). Default is None.
+	job_batch : str, optional
+		Name to keep the list under as a queue of jobs in the database (see job_queue.py). Each URL is marked done or failed as its record is written, so if the run is interrupted, calling download_from_list again with the same URLs and job_batch carries on where it stopped. Several processes can work on the same job_batch at once; a run waits for the URLs other runs are working on, and takes them over within JOB_LEASE_SECONDS (a minute) if those runs die. Raises RuntimeError if any URL of the batch is still unfinished at the end. URLs that already failed are not tried again; use job_queue.JobQueue(database, job_batch).retry_failed() for that. Default is None: progress is only kept in memory.
+	max_attempts : int, optional
+		Only used with job_batch. Number of runs that can die while working on a URL before it is marked failed, so a URL that keeps crashing the process doesn't stop the batch. Runs that stop cleanly, eg on Ctrl-C or an exception, don't count. Default is 3.
+	lookahead : int, optional
+		Only used when max_workers is more than 1 or there is a post_processor. Number of URLs read ahead of the downloads that have finished. Default is None: twice max_workers, plus the post_processor's queue_size.
+	post_processor : postprocess.PostProcessor, optional
+		Reads the metadata of each downloaded file (running ExifTool where needed), adds its extension and hands over its record on a separate pool of workers, so the download workers move straight on to the next URL (see postprocess.py). Only a limited number of files wait for it at once; downloads wait when it is full. The caller starts and shuts it down. Default is None: each download worker does all of this itself.
+	content_store : ContentStore, optional
+		Store keeping one copy of each distinct file, so the same file behind several URLs is only kept once; the later records hardlink to or point at the first copy. Pass the same store to every run that downloads into the same collection. Default is None: every download keeps its own file.
+	layout : layout.ShardedLayout, optional
+		Spreads the finished files over subdirectories of directory, eg content/3f/a2/, so no one directory holds millions of files. Use the same layout for every run into the same directory. Default is None: all files go in directory.
 	"""
-	resources_list = []
-	for url in urls:
-		try:
-			resource = DownloadResource(url, directory, collect_html, proxies)
-		# start the default database if user hasn't already started one
-		except peewee.InterfaceError:
-			logging.warning("No database started - will add download to default database 'files_from_urls.db'. You can change this behaviour by calling 'downloader.start_database'.")
-			start_database()
-			resource = DownloadResource(url, directory, collect_html, proxies)
-		# make dictionary of original url and id to return
-		resource_dict = {
-		'url_original' : resource.record.url_original,
-		'id' : resource.record.id}
-		resources_list.append(resource_dict)
-	return resources_lisT
+	results = list(_iter_results(urls, directory, collect_html, proxies, max_workers, max_per_host, hashes, session, use_head, record_batch_size, skip_known, refresh, retries, segments, rate_limiter, full_metadata, metrics, job_batch, max_attempts, lookahead, post_processor, content_store, layout))
+	if job_batch is not None:
+		queue = job_queue.JobQueue(database, job_batch)
+		counts = queue.counts()
+		unfinished = counts.get(job_queue.PENDING, 0) + counts.get(job_queue.IN_PROGRESS, 0)
+		if unfinished:
+			raise RuntimeError(f"Job batch '{job_batch}' still has {unfinished} unfinished jobs ({counts}) - run download_from_list again to finish them")
+		# include the URLs finished by earlier runs of the batch
+		return [{'url_original' : url, 'id' : resource_id} for _, url, resource_id in queue.results()]
+	results.sort(key=lambda result: result[0])
+	return [summary for _, summary in results]
+
+def iter_download_from_list(urls, directory="content", collect_html=False, proxies=None, max_workers=1, max_per_host=2, hashes=("md5",), session=None, use_head=False, record_batch_size=500, skip_known=False, refresh=False, retries=3, segments=1, rate_limiter=None, full_metadata=False, metrics=None, job_batch=None, max_attempts=3, lookahead=None, post_processor=None, content_store=None, layout=None):
+	"""Works like download_from_list, but is a generator: yields the dictionary of original url and database ID for each resource as soon as its record is written, in the order they finish. Memory use stays the same however many URLs there are.
+	Records are written in batches of record_batch_size, but a result is never held back more than a few seconds waiting for its batch. With max_workers=1 and no post_processor, each record is written as soon as its download finishes, as nothing else can finish while the next download runs. With job_batch, only the URLs downloaded by this run are yielded.
+	Takes the same parameters as download_from_list.
+	"""
+	for _, summary in _iter_results(urls, directory, collect_html, proxies, max_workers, max_per_host, hashes, session, use_head, record_batch_size, skip_known, refresh, retries, segments, rate_limiter, full_metadata, metrics, job_batch, max_attempts, lookahead, post_processor, content_store, layout, prompt=True):
+		yield summary
 
 def change_filename(self, rename_from_headers=False, rename_from_url=False, new_filename=None):
 	# TODO REPLACE THIS
-	"""Run this method over an existing DownloadObject to change the filename to a string of your choosing.
+	"""Run this method over an existing DownloadObject to change the filename to a string of your choosing. To rename many downloaded files and update their records, use rename_downloads.
 	Requires a DownloadObject. All other parameters are optional; only one will be actioned, with priority in the order set out below.
 	Will not rename to the same name as a file already present in the directory - will return with self.renamed = False.
 	...
@@ -382,11 +1193,137 @@ def change_filename(self, rename_from_headers=False, rename_from_url=False, new_
 			self.filepath = new_filepath
 			self.renamed = True
 		else:
-			logging.warning(f"Could not change filename of '{self.filename}' from {self.url_original}: new name '{new_filename}' already exists in {download_dir}")
+			logging.warning(f"Could not change filename of '{self.filename}' from {self.url_original}: new name '{new_filename}' already exists in {self.directory}")
 	else:
 		logging.warning(f"Could not change filename from {self.url_original} - no file was downloaded")
 
-def start_database(database_path="files_from_urls.db", reset_db=False):
+def _clean_filename(name, unquote_url=False):
+	"""Makes a filename from a URL or header safe to use on any system: no directories, no characters Windows won't allow, no leading or trailing dots or spaces. Returns None if nothing is left.
+	"""
+	if not name:
+		return None
+	if unquote_url:
+		name = unquote(name)
+	name = os.path.basename(name.replace("\\", "/"))
+	name = re.sub(r'[<>:"/\\|?*\x00-\x1f]', "_", name).strip(" .")
+	return name or None
+
+def _wanted_filename(current_filename, filename_from_headers, filename_from_url, sources):
+	"""Returns the filename rename_downloads would give a file, from the first of sources that has one, or None. Keeps the file's current extension if the new name has none.
+	"""
+	for source in sources:
+		if source == "headers":
+			name = _clean_filename(filename_from_headers)
+		elif source == "url":
+			name = _clean_filename(filename_from_url, unquote_url=True)
+		else:
+			raise ValueError(f"Unknown filename source '{source}' - use 'headers' or 'url'")
+		if name is not None:
+			if not os.path.splitext(name)[1]:
+				name += os.path.splitext(current_filename)[1]
+			return name
+	return None
+
+def _try_rename(rename):
+	"""Renames one file for rename_downloads, returning the rename if it worked or None if it didn't
+	"""
+	old_filepath, new_filepath, _ = rename
+	try:
+		os.rename(old_filepath, new_filepath)
+	except OSError as e:
+		logging.warning(f"Could not rename '{old_filepath}' to '{new_filepath}': {e}")
+		return None
+	return rename
+
+def rename_downloads(query=None, sources=("headers", "url"), max_workers=8, dry_run=False):
+	"""Renames downloaded files in bulk to the filenames found in their headers or URLs, and updates filename and filepath in their records in one transaction.
+	All the renames are planned from the Resources table in one pass before any file is touched. A new name is never one already in use in the file's directory, by a record in the database or by a file on disk - each directory is listed once, not checked file by file. Clashing names get a numbered suffix, eg "report_1.pdf", given out in record id order so the same records always get the same names. Files stay in their own directory, including any layout subdirectory.
+	Several records can share one file, eg "not modified" refreshes or a ContentStore in "reference" mode; all of them are updated.
+	Returns a list of (old filepath, new filepath) for the files renamed, or that would be renamed if dry_run.
+	...
+	Parameters
+	----------
+	query : peewee query, optional
+		Query on Resources choosing the records to rename, eg Resources.select().where(Resources.directory == "content"). Only successful downloads with a file are renamed. Default is None: every record.
+	sources : tuple of str, optional
+		Where to take each new filename from, in order of preference: "headers" for filename_from_headers, "url" for filename_from_url. A name without an extension keeps the file's current one. Files with no name from any source are left alone. Default is ("headers", "url").
+	max_workers : int, optional
+		Number of files renamed at the same time. Default is 8.
+	dry_run : bool, optional
+		Set to True to only plan the renames and return them, without renaming anything. Default is False.
+	"""
+	_ensure_database()
+	if query is None:
+		query = Resources.select()
+	query = (query
+		.select(Resources.id, Resources.filepath, Resources.filename_from_headers, Resources.filename_from_url)
+		.where((Resources.download_status == True) & Resources.filepath.is_null(False))
+		.order_by(Resources.id)
+		.tuples())
+
+	# one plan per file: the ids of the records pointing at it, and the name wanted by the first of them
+	plans = {}
+	for record_id, filepath, filename_from_headers, filename_from_url in query.iterator():
+		plan = plans.get(filepath)
+		if plan is None:
+			wanted = _wanted_filename(os.path.basename(filepath), filename_from_headers, filename_from_url, sources)
+			plans[filepath] = plan = (wanted, [])
+		plan[1].append(record_id)
+	directories = {os.path.dirname(filepath) for filepath, (wanted, _) in plans.items() if wanted is not None}
+
+	# names already in use in those directories, from every record in the database and one listing of each directory
+	taken = {directory: set() for directory in directories}
+	for (filepath,) in Resources.select(Resources.filepath).where(Resources.filepath.is_null(False)).tuples().iterator():
+		directory, filename = os.path.split(filepath)
+		if directory in taken:
+			taken[directory].add(os.path.normcase(filename))
+	for directory, names in taken.items():
+		try:
+			names.update(os.path.normcase(filename) for filename in os.listdir(directory or "."))
+		except OSError as e:
+			logging.warning(f"Could not list '{directory}': {e}")
+
+	renames = []
+	# where the numbering of each clashing name got to, so a popular name doesn't start again from 1
+	next_suffix = {}
+	for filepath, (wanted, record_ids) in plans.items():
+		directory, filename = os.path.split(filepath)
+		if wanted is None:
+			continue
+		stem, extension = os.path.splitext(wanted)
+		# already renamed, perhaps with a suffix, by an earlier run
+		if re.fullmatch(re.escape(stem) + r"(_\d+)?" + re.escape(extension), filename):
+			continue
+		key = (directory, os.path.normcase(wanted))
+		new_filename = wanted
+		number = next_suffix.get(key, 1)
+		while os.path.normcase(new_filename) in taken[directory]:
+			new_filename = f"{stem}_{number}{extension}"
+			number += 1
+		next_suffix[key] = number
+		taken[directory].add(os.path.normcase(new_filename))
+		renames.append((filepath, os.path.join(directory, new_filename), record_ids))
+	if dry_run:
+		return [(old_filepath, new_filepath) for old_filepath, new_filepath, _ in renames]
+
+	with ThreadPoolExecutor(max_workers=max_workers) as executor:
+		renamed = [rename for rename in executor.map(_try_rename, renames) if rename is not None]
+	try:
+		with database.atomic():
+			for old_filepath, new_filepath, record_ids in renamed:
+				(Resources
+					.update(filename=os.path.basename(new_filepath), filepath=new_filepath)
+					.where(Resources.id.in_(record_ids))
+					.execute())
+	except Exception:
+		# put the files back so they still match their records
+		for old_filepath, new_filepath, _ in renamed:
+			os.rename(new_filepath, old_filepath)
+		raise
+	logging.info(f"Renamed {len(renamed)} of {len(renames)} files")
+	return [(old_filepath, new_filepath) for old_filepath, new_filepath, _ in renamed]
+
+def start_database(database_path="files_from_urls.db", reset_db=False, pragmas=None):
 	"""Starts tbe database to be used by DownloadResource.
 	...
 	Parameters
@@ -395,6 +1332,8 @@ def start_database(database_path="files_from_urls.db", reset_db=False):
 		Desired name of database. Can be a path or just a filename. If just a filename, db will be created in the current directory. If none given, defaults to "files_from_urls.db" in current directory.
 	reset_db : bool, optional
 		set to True if you want to use the name of a database that may already exist and you want to overwrite it. Mainly for testing purposes. Default is 'False', so using the name of an existing db will add new entries to the existing db.	
+	pragmas : dict, optional
+		SQLite pragmas to set on each connection. Default is write-ahead logging with synchronous=normal, which lets downloads running at the same time write without waiting on an fsync for every commit.
 	"""	
 	# if reset_db = True then any existing db of that name will be deleted
 	if os.path.exists(database_path):
@@ -411,13 +1350,29 @@ def start_database(database_path="files_from_urls.db", reset_db=False):
 			os.makedirs(database_directory)
 
 	# initialise db and make the Resources table
-	database.init(database_path)
+	if pragmas is None:
+		pragmas = {"journal_mode": "wal", "synchronous": "normal"}
+	database.init(database_path, pragmas=pragmas)
 	try:
 		Resources.create_table()
 	except peewee.OperationalError:
 		print("This table already exists!")
+	_migrate_database()
+
+def _migrate_database():
+	"""Adds any Resources columns and indexes that are missing from a database made by an older version of this module
+	"""
+	table_name = Resources._meta.table_name
+	existing_columns = {column.name for column in database.get_columns(table_name)}
+	migrator = SqliteMigrator(database)
+	operations = [migrator.add_column(table_name, field.column_name, field) for field in Resources._meta.sorted_fields if field.column_name not in existing_columns]
+	if operations:
+		migrate(*operations)
+		logging.info(f"Added {len(operations)} new column(s) to the Resources table in '{database.database}'")
+	# only creates the indexes that don't exist yet - can take a while the first time on a big database
+	Resources._schema.create_indexes(safe=True)
 
-def download_file_from_url(url, directory="content", collect_html=False, proxies=None):
+def download_file_from_url(url, directory="content", collect_html=False, proxies=None, hashes=("md5",), session=None, use_head=False, refresh=False, retries=3, segments=1, rate_limiter=None, full_metadata=False, content_store=None, layout=None):
 	"""Run DownloadResource on a single URL, downloading the resource and returning its newly-minted database ID.
 	If you haven't already started a database it will use the default behaviour of using "files_from_urls.db" in current directory as the database, and adding new files if that db already exists, not resetting it.
 	...
@@ -431,14 +1386,69 @@ def download_file_from_url(url, directory="content", collect_html=False, proxies
 		Set to True if desired behaviour is to download resource if it is just an HTML page. Default is False: download attempt will fail with error message "Target was webpage - deleted"
 	proxies : dict, optional
 		Pass a proxies dictionary if it will be required for requests.
+	hashes : tuple of str, optional
+		Hashes to compute while the file is written, from "md5", "sha1" and "sha256". Default is ("md5",).
+	session : requests.Session, optional
+		Session to make requests through. Default is the pooled session shared by all downloads (see http_session.py).
+	use_head : bool, optional
+		Set to True to resolve redirects with a HEAD request before the GET, for servers that need it. Default is False.
+	refresh : bool, optional
+		Set to True to re-request the URL with the 'ETag' and 'Last-Modified' validators from its last download, so an unchanged file is recorded as "not modified" instead of being downloaded again. Default is False.
+	retries : int, optional
+		Number of times an interrupted download carries on from where it stopped with a Range request, if the server allows it. Default is 3.
+	segments : int, optional
+		Number of byte ranges to download at the same time for large files, if the server reports a 'Content-Length' and accepts Range requests. Default is 1.
+	rate_limiter : rate_limiter.RateLimiter, optional
+		Limiter holding each host to its own request rate. Default is the limiter shared by all downloads, which allows 2 requests per second to each host (see rate_limiter.py).
+	full_metadata : bool, optional
+		Set to True to always run ExifTool. Default is False: common file types are recognised from their first bytes and ExifTool is only run on the rest.
+	content_store : ContentStore, optional
+		If given and a file with the same hash has already been downloaded, the new record hardlinks to or points at that file instead of keeping another copy. Default is None.
+	layout : layout.ShardedLayout, optional
+		If given, the file is moved into subdirectories of directory named after the start of its UUID or hash. Default is None.
 	"""
 
-	try:
-		target_resource = DownloadResource(url, directory, collect_html, proxies)
-	# start the default database if user hasn't already started one
-	except peewee.InterfaceError:
-		logging.warning("No database started - will add download to default database 'files_from_urls.db'. You can change this behaviour by calling 'downloader.start_database'.")
-		start_database()
-	target_resource = DownloadResource(url, directory, collect_html, proxies)
+	_ensure_database()
+	target_resource = DownloadResource(url, directory, collect_html, proxies, hashes=hashes, session=session, use_head=use_head, refresh=refresh, retries=retries, segments=segments, rate_limiter=rate_limiter, full_metadata=full_metadata, content_store=content_store, layout=layout)
 	# return the new database id for the resource
-	return target_resource.record.id
\ No newline at end of file
+	return target_resource.record.id
+
+def lookup_url(url):
+	"""Returns a list of the Resources records whose original or final URL is the given URL, oldest first.
+	Use this to check whether a URL has already been fetched.
+	...
+	Parameters
+	----------
+	url : str
+		URL to look for. Spaces and trailing slashes are stripped from the URL to match url_final.
+	"""
+	url_stripped = url.strip().rstrip("/")
+	query = (Resources
+		.select()
+		.where((Resources.url_original == url) | (Resources.url_final == url_stripped))
+		.order_by(Resources.id))
+	return list(query)
+
+def lookup_hash(md5):
+	"""Returns a list of the Resources records whose file has the given md5 hash, oldest first
+	...
+	Parameters
+	----------
+	md5 : str
+		md5 hash as a hex string
+	"""
+	return list(Resources.select().where(Resources.md5 == md5.lower()).order_by(Resources.id))
+
+def list_duplicates():
+	"""Returns a dictionary of md5 hash to the list of Resources records sharing that hash, for every hash held by more than one record
+	"""
+	duplicate_hashes = (Resources
+		.select(Resources.md5)
+		.where(Resources.md5.is_null(False))
+		.group_by(Resources.md5)
+		.having(peewee.fn.COUNT(Resources.id) > 1))
+	query = (Resources
+		.select()
+		.where(Resources.md5.in_(duplicate_hashes))
+		.order_by(Resources.md5, Resources.id))
+	return {md5: list(records) for md5, records in itertools.groupby(query, key=lambda record: record.md5)}
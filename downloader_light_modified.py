@@ -14,19 +14,24 @@ Function "download_from_list" takes a list, tuple or set of URLs and passes each
 
 You may wish to first run "start_database" if you want to provide a path for your database, and/or to reset the database before downloading anything (eg for testing).
 
+Method "output_to_sink" adds the results of a download to an export.RecordSink, so the results of a whole run can be appended to one CSV, JSON Lines or Parquet file.
+
 Function "change_filename" can be run after a resource is downloaded and a DownloadObject has been created. You can use this to change the UUID filename to an alternative of your choosing, including the filename_from_headers or filename_from_url.
 
 """
 
 from datetime import datetime
-import exiftool # req
-import hashlib
+import exiftool_pool
+import http_session
 import logging
 import ntpath
 import os
 import re
 import requests # req
+from sniffer import looks_like_html, sniff_filetype
+from streaming import download_segmented, peek
 import time
+from timing import StageTimer
 from urllib.parse import urlparse, urlunparse
 import uuid
 
@@ -46,16 +51,20 @@ class DownloadResource:
 	get_real_download_url
 	get_original_filename_from_url
 	get_original_filename_from_request_headers
+	check_for_webpage
 	download_file
 	get_file_metadata
 	add_file_extension
+	final_directory
+	output_as_dictionary
+	output_to_sink
 
 	Can be run after creation of object to change filename to user preference:
 	change_filename
 		
 	"""
 
-	def __init__(self, url, directory, collect_html, proxies):
+	def __init__(self, url, directory, collect_html, proxies, hashes=("md5",), session=None, use_head=False, retries=3, segments=1, rate_limiter=None, full_metadata=False, layout=None):
 		"""
 		Parameters
 		----------
@@ -67,6 +76,22 @@ class DownloadResource:
 			Set to True if desired behaviour is to download resource if it is just an HTML page. Default is False: download attempt will fail with error message "Target was webpage - deleted"
 		proxies : dict, optional
 			Pass a proxies dictionary if it will be required for requests.
+		hashes : tuple of str, optional
+			Hashes to compute while the file is written, from "md5", "sha1" and "sha256". Default is ("md5",).
+		session : requests.Session, optional
+			Session to make requests through. Default is the pooled session shared by all downloads (see http_session.py).
+		use_head : bool, optional
+			Set to True to resolve redirects with HEAD requests before the GET, for servers that need it. Default is False: a single GET follows the redirects and its response is downloaded directly.
+		retries : int, optional
+			Number of times an interrupted download carries on from where it stopped with a Range request, if the server allows it. Default is 3.
+		segments : int, optional
+			Number of byte ranges to download at the same time for large files (32 MB or more with 4 segments), if the server reports a 'Content-Length' and accepts Range requests. Default is 1: files are downloaded in one stream.
+		rate_limiter : rate_limiter.RateLimiter, optional
+			Limiter holding each host to its own request rate, eg rate_limiter.get_limiter() to share one with other downloads. Default is None: no limit.
+		full_metadata : bool, optional
+			Set to True to always run ExifTool and keep everything it reports in self.metadata. Default is False: common file types are recognised from their first bytes and ExifTool is only run on the rest.
+		layout : layout.ShardedLayout, optional
+			If given, the finished file is moved into subdirectories of directory named after the start of its UUID or hash, so no one directory holds every file. Default is None: files stay in directory.
 		"""
 
 		self.download_status = None
@@ -75,6 +100,19 @@ class DownloadResource:
 		self.directory = directory
 		self.collect_html = collect_html
 		self.proxies = proxies
+		self.hashes = hashes
+		self.session = session if session is not None else http_session.get_session()
+		self.use_head = use_head
+		self.retries = retries
+		self.segments = segments
+		self.rate_limiter = rate_limiter
+		self.full_metadata = full_metadata
+		self.layout = layout
+		if layout is not None and layout.key == "hash" and layout.hash_name not in hashes:
+			raise ValueError(f"layout uses {layout.hash_name}, which is not in hashes {hashes}")
+		self.prefix = b""
+		self.metadata = None
+		self.r = None
 		self.url_original = url
 		self.url_final = None
 		self.filename_from_headers = None
@@ -86,11 +124,17 @@ class DownloadResource:
 		self.mimetype = None
 		#!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 		self.md5 = None
+		self.sha1 = None
+		self.sha256 = None
 		self.size_original = None
 		self.filesize = None
 		self.md5_original = None
 		self.exists = False
 		self.jhove_check = False
+		self.bytes_transferred = None
+		self.ttfb = None
+		# monotonic timings of each stage, included in output_as_dictionary
+		self.timer = StageTimer()
 #________________________________________________________________________
 
 				
@@ -109,9 +153,12 @@ class DownloadResource:
 			self.get_original_filename_from_request_headers()
 			self.get_original_size_from_headers()
 			self.get_original_md5_check_from_headers()
-			self.download_file()
+			self.check_for_webpage()
+			if self.download_status != False:
+				self.download_file()
 			# try:
-			self.get_file_metadata()
+			if self.download_status == True:
+				self.get_file_metadata()
 			# except UnicodeDecodeError as e:
 			# 	print(str(e))
 			# 	print("!!!!!!!!!!!!!!!!!")
@@ -142,14 +189,15 @@ class DownloadResource:
 		# this is here in case something somehow makes it through without changing download_status to True or False
 		else:
 			logging.warning("{self.url_original} NO STATUS SET.")
+		self.timer.finish()
 		
 
 	def output_as_file(self):
 
-		"""Writes the results as file a text file"""
+		"""Writes the results as file a text file. The file is overwritten by each download - use output_to_sink to keep the results of many downloads in one file."""
 
 		with open("my_file.txt" ,"w")  as f:
-			f.write("[configuration]\nurl_original = {}\nurl_final = {}\ndatetime = {}\ndownload_status = {}\nmessage = {}\nfilename_from_url = {}\nfilename_from_headers = {}\nfilename = {}\ndirectory = {}\nfilepath = {}\nfiletype_extension = {}\nmimetype = {}\nfilesize = {}\nsize_original = {}\nmd5 = {}\noriginal_md5 = {}".format( self.url_original, self.url_final, datetime.now(), self.download_status, self.message, self.filename_from_url, self.filename_from_headers,   self.filename, self.directory, self.filepath, self.filetype_extension,  self.mimetype, self.filesize, self.size_original, self.md5, self.md5_original))
+			f.write("[configuration]\nurl_original = {}\nurl_final = {}\ndatetime = {}\ndownload_status = {}\nmessage = {}\nfilename_from_url = {}\nfilename_from_headers = {}\nfilename = {}\ndirectory = {}\nfilepath = {}\nfiletype_extension = {}\nmimetype = {}\nfilesize = {}\nsize_original = {}\nmd5 = {}\nsha1 = {}\nsha256 = {}\noriginal_md5 = {}".format( self.url_original, self.url_final, datetime.now(), self.download_status, self.message, self.filename_from_url, self.filename_from_headers,   self.filename, self.directory, self.filepath, self.filetype_extension,  self.mimetype, self.filesize, self.size_original, self.md5, self.sha1, self.sha256, self.md5_original))
 
 	def output_as_dictionary(self):
 
@@ -158,22 +206,28 @@ class DownloadResource:
 			my_dictionary(dict) - contains all result information
 
 		"""
-		my_dictionary =  {"url_original":self.url_original, "url_final":self.url_final,  "datetime" : self.datetime, "download_status" : self.download_status, "message": self.message,  "filename_from_url":self.filename_from_url, "filename_from_headers":self.filename_from_headers, "filename":self.filename, "directory":self.directory, "filepath":self.filepath, "filetype_extension":self.filetype_extension, "mimetype":self.mimetype,"filesize":self.filesize, "size_original":self.size_original, "md5" :self.md5,  "md5_original": self.md5_original}
+		my_dictionary =  {"url_original":self.url_original, "url_final":self.url_final,  "datetime" : self.datetime, "download_status" : self.download_status, "message": self.message,  "filename_from_url":self.filename_from_url, "filename_from_headers":self.filename_from_headers, "filename":self.filename, "directory":self.directory, "filepath":self.filepath, "filetype_extension":self.filetype_extension, "mimetype":self.mimetype,"filesize":self.filesize, "size_original":self.size_original, "md5" :self.md5, "sha1": self.sha1, "sha256": self.sha256, "md5_original": self.md5_original, "bytes_transferred": self.bytes_transferred, "ttfb": self.ttfb}
+		# time_wait, time_request, time_download... in seconds - see timing.py
+		my_dictionary.update(self.timer.as_fields())
 		return my_dictionary
 
+	def output_to_sink(self, sink):
+		"""Adds the results from output_as_dictionary to an export.RecordSink, which appends them to a CSV, JSON Lines or Parquet file with the results of other downloads
+		"""
+		sink.add(self.output_as_dictionary())
+
 	def get_real_download_url(self):
 		"""Cleans any spaces and trailing slashes from the given URL and resolves any redirects. If it encounters a 302 redirect, it picks up the cookies it will need to resolve the final URL. 
 		Logs error if unable to retrieve URL.
 		"""
 		user_agent = 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/78.0.3904.108 Safari/537.36'
 		headers = {'User-Agent': user_agent}
+		# kept for any Range requests made by download_file
+		self.headers = headers
 
-		session = requests.Session()
-		session.verify = False
+		# the session is shared with other downloads, so verify and proxies are set on each request rather than on the session
+		session = self.session
 		#print("here1")
-		# set proxies for the session if needed
-		if self.proxies != None:
-			session.proxies.update(self.proxies)
 
 		url_stripped = self.url_original.strip().rstrip("/")
 		#print("	here2")
@@ -181,30 +235,66 @@ class DownloadResource:
 		try:
 			#print("here3")
 			cookies = None
-			response = session.head(url_stripped, allow_redirects=True)
-			#print("here4")
-			# if it encounters a 302 response in the redirect chain, save the cookie
-			if response.history:
-				#print("here5")
-				for resp in response.history:
-					#print("here6")
+			if self.use_head:
+				self.wait_for_host(url_stripped)
+				with self.timer.stage("head"):
+					response = session.head(url_stripped, allow_redirects=True, verify=False, proxies=self.proxies)
+				#print("here4")
+				# if it encounters a 302 response in the redirect chain, save the cookie
+				if response.history:
+					#print("here5")
+					for resp in response.history:
+						#print("here6")
+						if resp.status_code == 302:
+							cookies = resp.cookies
+					# request the final url again with the cookie
+					with self.timer.stage("head"):
+						response = session.head(response.url, cookies=cookies, verify=False, proxies=self.proxies)
+
+				self.url_final = response.url
+
+				#print("here 7")
+																
+				# get the thing, recording the time
+				self.datetime = datetime.now()
+				#print("here8")
+				# stream the body so download_file can write it to disk without holding it all in memory
+				self.wait_for_host(self.url_final)
+				with self.timer.stage("request"):
+					self.r = session.get(self.url_final, timeout=(5,14), cookies= cookies, headers=headers, verify=False, proxies=self.proxies, stream=True)
+			else:
+				# one streamed GET follows the redirects, recording the time
+				self.datetime = datetime.now()
+				self.wait_for_host(url_stripped)
+				with self.timer.stage("request"):
+					self.r = session.get(url_stripped, allow_redirects=True, timeout=(5,14), headers=headers, verify=False, proxies=self.proxies, stream=True)
+				# if it encounters a 302 response in the redirect chain, save the cookie
+				for resp in self.r.history:
 					if resp.status_code == 302:
 						cookies = resp.cookies
-				# request the final url again with the cookie
-				response = session.head(response.url, cookies=cookies)
-
-			self.url_final = response.url
+				# if the final url refused us, request it again with the cookie
+				if cookies and not self.r.ok:
+					self.r.close()
+					self.wait_for_host(self.r.url)
+					with self.timer.stage("request"):
+						self.r = session.get(self.r.url, timeout=(5,14), cookies=cookies, headers=headers, verify=False, proxies=self.proxies, stream=True)
 
-			#print("here 7")
-															
-			# get the thing, recording the time
-			self.datetime = datetime.now()
-			#print("here8")
-			self.r = requests.get(self.url_final, timeout=(5,14), cookies= cookies, headers=headers, verify=False)
+				self.url_final = self.r.url
 
 			#print("here9")
 
 			print(self.r.status_code)
+			if self.rate_limiter is not None:
+				retries = self.rate_limiter.retries
+				# a 429 or 503 with 'Retry-After' pauses the host; ask again once the pause is over
+				while self.rate_limiter.check_response(self.r) is not None and retries > 0:
+					retries -= 1
+					self.r.close()
+					self.wait_for_host(self.r.url)
+					with self.timer.stage("request"):
+						self.r = session.get(self.r.url, timeout=(5,14), cookies=cookies, headers=headers, verify=False, proxies=self.proxies, stream=True)
+			# with stream=True, elapsed runs from sending the request to parsing the headers
+			self.ttfb = self.r.elapsed.total_seconds()
 			
 			self.r.raise_for_status()
 
@@ -213,6 +303,7 @@ class DownloadResource:
 			#print("here10")
 			self.download_status = False
 			self.message = f"HTTPError: {self.r.status_code}"
+			self.r.close()
 		except requests.exceptions.ConnectionError as e:
 			#print (e)
 			#print("here11")
@@ -223,6 +314,13 @@ class DownloadResource:
 			self.download_status = False
 			self.message = f"RequestException: {e}"
 
+	def wait_for_host(self, url):
+		"""Waits until the rate limiter, if one was given, allows a request to the host of url
+		"""
+		if self.rate_limiter is not None:
+			with self.timer.stage("wait"):
+				self.rate_limiter.wait(url)
+
 	def get_original_filename_from_url(self):	
 		"""grabs the bit of the url after the last "/" in the URL path
 		(See https://docs.python.org/3/library/urllib.parse.html)
@@ -260,29 +358,60 @@ class DownloadResource:
 			self.md5_original = self.r.headers.get('Content-MD5')
 #__________________________________________________________________________________________________________________________________
 
+	def check_for_webpage(self):
+		"""Reads the first few KB of the response, which get_file_metadata also uses to recognise the file type.
+		If HTML pages aren't wanted, judges from the 'Content-Type' and those bytes whether it is a web page, and if so drops it before anything is written to disk
+		"""
+		with self.timer.stage("sniff"):
+			self.prefix = peek(self.r)
+		if self.collect_html == True:
+			return
+		if looks_like_html(self.r.headers.get('Content-Type'), self.prefix):
+			# closing without reading the rest of the body aborts the transfer
+			self.r.close()
+			self.bytes_transferred = len(self.prefix)
+			self.download_status = False
+			self.message = "Target was webpage - deleted"
+			self.directory = None
+
 	def download_file(self):
-		"""Downloads the resource, minting a unique filename from a UUID and creating the destination directory first if necessary
+		"""Downloads the resource, minting a unique filename from a UUID and creating the destination directory first if necessary.
+		The file is hashed as it is written, so it never has to be read back from disk. Large files can be split into segments downloaded in parallel. An interrupted download is resumed if the server allows it, otherwise a ".part" file is kept in the directory for the next attempt.
 		"""
 
-		if not os.path.exists(self.directory): os.makedirs(self.directory)
+		os.makedirs(self.directory, exist_ok=True)
 		self.filename = str(uuid.uuid4())
 		self.filepath = os.path.join(self.directory, self.filename)
 
-		with open(self.filepath, 'wb') as f:
-			for chunk in self.r.iter_content(100000):
-				f.write(chunk)
+		try:
+			# with one segment this is a plain resumable download
+			with self.timer.stage("download"):
+				writer = download_segmented(self.session, self.r, self.filepath, self.hashes, segments=self.segments, retries=self.retries, rate_limiter=self.rate_limiter, timeout=(5,14), headers=self.headers, verify=False, proxies=self.proxies)
+		except (requests.exceptions.RequestException, OSError) as e:
+			self.download_status = False
+			# a file that can't be written or moved into place fails this download only
+			self.message = f"Download interrupted: {e}" if isinstance(e, requests.exceptions.RequestException) else f"Could not save file: {e}"
+			self.filename, self.filepath = None, None
+			return
+		self.digests = writer.hexdigests()
+		self.filesize = writer.bytes_written
+		self.timer.add("hash", writer.hash_seconds)
+		self.bytes_transferred = writer.bytes_downloaded
 		self.download_status = True
 
 	def get_file_metadata(self):
-		"""Uses EXIFtool to get file extension and MIMEtype, then gets md5 hash
+		"""Gets file extension and MIMEtype, then records the hashes taken during download_file.
+		Common file types are recognised from their first bytes; EXIFtool is only run on anything else, or on everything if full_metadata was set.
 		"""
 
-#***	# TODO: put exiftool.exe somewhere where it doesn't need the full path
-		with exiftool.ExifToolHelper() as et:
-			#print(dir(et))
-			metadata = et.get_metadata(self.filepath)
-
-		metadata = metadata[0]
+		with self.timer.stage("metadata"):
+			sniffed = None if self.full_metadata else sniff_filetype(self.prefix)
+			if sniffed is not None:
+				metadata = {'File:FileTypeExtension': sniffed[0], 'File:MIMEType': sniffed[1], 'File:FileSize': self.filesize}
+			else:
+				# shared pool of running ExifTool processes - use exiftool_pool.start_pool to set the path to exiftool.exe
+				metadata = exiftool_pool.get_metadata(self.filepath)
+		self.metadata = metadata
 		#print('File:FileSize' in metadata)
 		# if discarding html pages, this happens here
 		if self.collect_html == False:
@@ -301,7 +430,7 @@ class DownloadResource:
 			if self.message == None:
 				self.message = "Unknown filetype"
 			else:
-				self.message = "{message} ; Unknown filetype"		
+				self.message = f"{self.message} ; Unknown filetype"		
 		# print("'File:FileSize' in metadata")
 		if 'File:FileTypeExtension' in metadata:
 			#print("here")
@@ -320,25 +449,36 @@ class DownloadResource:
 			# print(type(self.filesize))
 			# print("!!!!!!!!!!!!!!!!!!!!!")
 
-		else:
-			self.filesize = None
-		hash_md5 = hashlib.md5()
-		with open(self.filepath, "rb") as f:
-			for chunk in iter(lambda: f.read(4096), b""):
-				hash_md5.update(chunk)
-				self.md5 = hash_md5.hexdigest()
+		self.md5 = self.digests.get("md5")
+		self.sha1 = self.digests.get("sha1")
+		self.sha256 = self.digests.get("sha256")
 
 
 
 	def add_file_extension(self):
-		"""Adds correct file extension as found by EXIFtool to filename 
+		"""Adds correct file extension as found by EXIFtool to filename, and moves the file into its subdirectory if there is a layout
 		"""
+		new_directory = self.final_directory()
+		new_filename = self.filename
 		if self.filetype_extension != None:
-			new_filepath = os.path.join(self.directory, self.filename + os.extsep + self.filetype_extension.lower())
-			os.rename(self.filepath, new_filepath)
+			new_filename = self.filename + os.extsep + self.filetype_extension.lower()
+		if (new_directory, new_filename) != (self.directory, self.filename):
+			new_filepath = os.path.join(new_directory, new_filename)
+			with self.timer.stage("rename"):
+				if new_directory != self.directory:
+					os.makedirs(new_directory, exist_ok=True)
+				os.rename(self.filepath, new_filepath)
+			self.directory = new_directory
 			self.filepath = new_filepath
 			self.filename = str(ntpath.basename(self.filepath))
 
+	def final_directory(self):
+		"""Returns the directory the finished file belongs in: its subdirectory if there is a layout, else the directory it was downloaded to
+		"""
+		if self.layout is None:
+			return self.directory
+		return self.layout.place(self.directory, self.filename, self.digests)
+
 
 
 	def change_filename(self, rename_from_headers=False, rename_from_url=False, new_filename=None, custom_name=None):
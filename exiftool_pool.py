@@ -0,0 +1,188 @@
+#! /usr/bin/env python3
+
+"""
+Module to share long-running ExifTool processes between downloads.
+
+Starting ExifTool forks a new Perl process, which for small files can take longer than the download itself. The class "ExifToolPool" keeps a few ExifTool processes running in "-stay_open" mode and feeds them files from a shared queue. When several files are waiting, a worker sends them to ExifTool together in one get_metadata call. If a worker's ExifTool process dies, the worker starts a new one and tries the files again.
+
+Function "get_metadata" is what the downloaders use: it sends one file through the shared pool and returns its metadata dictionary. The shared pool is started the first time it is needed.
+
+You may wish to first run "start_pool" if you want to choose the number of ExifTool processes or the path to the ExifTool executable.
+
+"""
+
+import atexit
+from concurrent.futures import Future
+import exiftool # req
+import logging
+import os
+import queue
+import threading
+
+class ExifToolPool:
+	"""Keeps a number of ExifTool processes running and shares the files to be read between them.
+	...
+	Parameters
+	----------
+	workers : int, optional
+		Number of ExifTool processes to keep running. Defaults to the number of CPUs, up to 4.
+	batch_size : int, optional
+		Most files that will be sent to one ExifTool process in a single call. Default is 16.
+	executable : str, optional
+		Path to the ExifTool executable if it is not on the path.
+
+	METHODS
+	-------
+
+	submit
+	get_metadata
+	shutdown
+	"""
+
+	def __init__(self, workers=None, batch_size=16, executable=None):
+		if workers is None:
+			workers = min(4, os.cpu_count() or 1)
+		self.batch_size = batch_size
+		self.executable = executable
+		self._queue = queue.Queue()
+		self._local = threading.local()
+		self._closed = False
+		self._threads = []
+		for number in range(workers):
+			thread = threading.Thread(target=self._work, name=f"exiftool-{number}", daemon=True)
+			thread.start()
+			self._threads.append(thread)
+
+	def submit(self, filepath):
+		"""Queues a file to be read by the next free ExifTool process and returns a Future for its metadata dictionary
+		"""
+		if self._closed:
+			raise RuntimeError("ExifToolPool has been shut down")
+		future = Future()
+		self._queue.put((filepath, future))
+		return future
+
+	def get_metadata(self, filepath):
+		"""Returns the metadata dictionary for a file, waiting for a free ExifTool process if needed
+		"""
+		return self.submit(filepath).result()
+
+	def shutdown(self):
+		"""Lets the workers finish any files already queued, then stops all the ExifTool processes
+		"""
+		if self._closed:
+			return
+		self._closed = True
+		for thread in self._threads:
+			self._queue.put(None)
+		for thread in self._threads:
+			thread.join()
+
+	def _work(self):
+		"""Runs in each worker thread: takes files off the queue and sends them to this worker's ExifTool process
+		"""
+		stopping = False
+		while not stopping:
+			item = self._queue.get()
+			if item is None:
+				break
+			batch = [item]
+			# pick up anything else already waiting so it goes to ExifTool in the same call
+			while len(batch) < self.batch_size:
+				try:
+					item = self._queue.get_nowait()
+				except queue.Empty:
+					break
+				if item is None:
+					stopping = True
+					break
+				batch.append(item)
+			self._process(batch)
+
+		et = getattr(self._local, "et", None)
+		if et is not None and et.running:
+			et.terminate()
+
+	def _process(self, batch):
+		"""Gets metadata for a batch of (filepath, future) pairs and hands each result to its future
+		"""
+		filepaths = [filepath for filepath, future in batch]
+		try:
+			results = self._call_exiftool(filepaths)
+			if len(results) != len(filepaths):
+				raise exiftool.exceptions.ExifToolOutputEmptyError(0, "", "", filepaths)
+		except Exception as e:
+			if len(batch) == 1:
+				batch[0][1].set_exception(e)
+				return
+			# one bad file can spoil the whole call, so try each file on its own
+			logging.info(f"ExifTool failed on a batch of {len(batch)} files, retrying one at a time: {e}")
+			for item in batch:
+				self._process([item])
+			return
+
+		for (filepath, future), metadata in zip(batch, results):
+			future.set_result(metadata)
+
+	def _call_exiftool(self, filepaths):
+		"""Runs get_metadata on this worker's ExifTool process, starting a new process if there isn't one or if it has died
+		"""
+		et = self._running_exiftool()
+		try:
+			return et.get_metadata(filepaths)
+		except Exception:
+			if et.running:
+				raise
+			logging.warning("ExifTool process died - restarting it")
+			return self._running_exiftool().get_metadata(filepaths)
+
+	def _running_exiftool(self):
+		et = getattr(self._local, "et", None)
+		if et is None or not et.running:
+			# check_execute is off so files ExifTool can't read come back with 'ExifTool:Error' rather than raising
+			et = exiftool.ExifToolHelper(executable=self.executable, check_execute=False)
+			et.run()
+			self._local.et = et
+		return et
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def start_pool(workers=None, batch_size=16, executable=None):
+	"""Starts the shared ExifTool pool used by the downloaders, replacing any pool already running.
+	...
+	Parameters
+	----------
+	workers : int, optional
+		Number of ExifTool processes to keep running. Defaults to the number of CPUs, up to 4.
+	batch_size : int, optional
+		Most files that will be sent to one ExifTool process in a single call. Default is 16.
+	executable : str, optional
+		Path to the ExifTool executable if it is not on the path.
+	"""
+	global _pool
+	with _pool_lock:
+		old_pool = _pool
+		_pool = ExifToolPool(workers, batch_size, executable)
+	if old_pool is not None:
+		old_pool.shutdown()
+	return _pool
+
+def get_pool():
+	"""Returns the shared ExifTool pool, starting it with the default settings if it isn't running yet
+	"""
+	global _pool
+	with _pool_lock:
+		if _pool is None:
+			_pool = ExifToolPool()
+		return _pool
+
+def get_metadata(filepath):
+	"""Returns the ExifTool metadata dictionary for a single file, using the shared pool
+	"""
+	return get_pool().get_metadata(filepath)
+
+@atexit.register
+def _shutdown_pool():
+	if _pool is not None:
+		_pool.shutdown()
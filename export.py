@@ -0,0 +1,275 @@
+#! /usr/bin/env python3
+
+"""
+Module to write download records out in bulk as CSV, JSON Lines or Parquet, without holding them all in memory.
+
+Class "RecordSink" appends records (dictionaries, or rows of values) to a file in any of the three formats. It keeps a batch of records in memory and writes the whole batch at once. The light downloader has no database: pass each DownloadResource to a RecordSink with its output_to_sink method to keep the results of a whole run in one file.
+
+Function "export_resources" streams the Resources table of the downloader's database, or any query on it, into a file through a RecordSink. It reads rows from a cursor as it writes, so memory use stays the same however many records there are.
+
+Run it from the command line to export a whole database:
+
+	python export.py files_from_urls.db resources.parquet
+
+Parquet needs pyarrow, which is optional: pip install pyarrow
+
+"""
+
+import argparse
+import csv
+from datetime import datetime
+import downloader
+import itertools
+import json
+import os
+import threading
+
+try:
+	import pyarrow # optional
+	import pyarrow.parquet # optional
+except ImportError:
+	pyarrow = None
+
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet"}
+# peewee column types of the Resources fields, as the types RecordSink writes to Parquet
+PEEWEE_TYPES = {"AUTO": "int", "INT": "int", "FLOAT": "float", "BOOL": "bool", "DATETIME": "datetime"}
+# size of the write buffer for CSV and JSON Lines files
+FILE_BUFFER = 1024 * 1024
+
+def _infer_type(values):
+	"""Returns the Parquet column type for a list of values, from the first that isn't None. Columns with no values are strings.
+	"""
+	for value in values:
+		if value is None:
+			continue
+		if isinstance(value, bool):
+			return "bool"
+		if isinstance(value, int):
+			return "int"
+		if isinstance(value, float):
+			return "float"
+		if isinstance(value, datetime):
+			return "datetime"
+		return "str"
+	return "str"
+
+class RecordSink:
+	"""Appends records to a CSV, JSON Lines or Parquet file, batch_size at a time. Safe to add to from several threads.
+	Can be used as a context manager, which writes anything left over and closes the file on exit.
+	...
+	Parameters
+	----------
+	path : str
+		File to write to. CSV and JSON Lines files that already exist are added to; a CSV file keeps the columns of its header. A Parquet file can't be added to once it is closed, so it must not already exist.
+	format : str, optional
+		"csv", "jsonl" or "parquet". Default is None: taken from the extension of path (.csv, .jsonl or .ndjson, .parquet).
+	fields : list of str, optional
+		Columns to write, in order. Keys of a record not in fields are left out, and missing ones are left empty. Default is None: the keys of the first record.
+	batch_size : int, optional
+		Number of records kept in memory before they are written. With Parquet, this is also the number of rows in each row group. Default is 10000.
+	types : dict, optional
+		Only used with Parquet. Type of each column: "str", "int", "float", "bool" or "datetime". Values are converted to these types a column at a time, eg 1/0 to booleans or text to times. Default is None: taken from the first batch of records.
+
+	METHODS
+	-------
+
+	add
+	add_many
+	add_rows
+	flush
+	close
+	"""
+
+	def __init__(self, path, format=None, fields=None, batch_size=10000, types=None):
+		if format is None:
+			format = FORMATS.get(os.path.splitext(path)[1].lower())
+			if format is None:
+				raise ValueError(f"Can't tell the export format from '{path}' - pass format as 'csv', 'jsonl' or 'parquet'")
+		if format not in ("csv", "jsonl", "parquet"):
+			raise ValueError(f"Unknown export format '{format}'")
+		if format == "parquet":
+			if pyarrow is None:
+				raise ImportError("Writing Parquet needs pyarrow: pip install pyarrow")
+			if os.path.exists(path):
+				raise ValueError(f"'{path}' already exists - a Parquet file can't be added to")
+		self.path = path
+		self.format = format
+		self.fields = list(fields) if fields is not None else None
+		self.batch_size = batch_size
+		self.types = dict(types) if types is not None else None
+		self.count = 0
+		# rows of values in the order of fields
+		self._pending = []
+		self._lock = threading.Lock()
+		self._file = None
+		self._writer = None
+		self._schema = None
+		if format == "csv" and fields is None and os.path.exists(path) and os.path.getsize(path) > 0:
+			# keep the columns of the file being added to
+			with open(path, newline="", encoding="utf-8") as f:
+				self.fields = next(csv.reader(f))
+
+	def add(self, record):
+		"""Queues one record (a dictionary), writing the batch if it is now full
+		"""
+		with self._lock:
+			if self.fields is None:
+				self.fields = list(record)
+			self._pending.append(tuple(record.get(field) for field in self.fields))
+			if len(self._pending) >= self.batch_size:
+				self._write()
+
+	def add_many(self, records):
+		"""Queues records (dictionaries) from any iterable, writing each batch as it fills
+		"""
+		for record in records:
+			self.add(record)
+
+	def add_rows(self, rows):
+		"""Queues rows of values already in the order of fields, eg straight from a database cursor, writing each batch as it fills. Needs fields.
+		"""
+		if self.fields is None:
+			raise ValueError("add_rows needs the fields to be given")
+		for rows in _batches(rows, self.batch_size):
+			with self._lock:
+				self._pending.extend(rows)
+				if len(self._pending) >= self.batch_size:
+					self._write()
+
+	def flush(self):
+		"""Writes the queued records
+		"""
+		with self._lock:
+			self._write()
+			if self._file is not None:
+				self._file.flush()
+
+	def close(self):
+		"""Writes the queued records and closes the file
+		"""
+		with self._lock:
+			self._write()
+			if self._writer is not None and self.format == "parquet":
+				self._writer.close()
+			if self._file is not None:
+				self._file.close()
+			self._file, self._writer = None, None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def _write(self):
+		"""Writes the queued rows in one go. Called with the lock held.
+		"""
+		rows, self._pending = self._pending, []
+		if not rows:
+			return
+		if self.format == "csv":
+			self._write_csv(rows)
+		elif self.format == "jsonl":
+			self._write_jsonl(rows)
+		else:
+			self._write_parquet(rows)
+		self.count += len(rows)
+
+	def _open(self):
+		if self._file is None:
+			self._file = open(self.path, "a", newline="", encoding="utf-8", buffering=FILE_BUFFER)
+		return self._file
+
+	def _write_csv(self, rows):
+		if self._writer is None:
+			new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+			self._writer = csv.writer(self._open())
+			if new_file:
+				self._writer.writerow(self.fields)
+		self._writer.writerows(rows)
+
+	def _write_jsonl(self, rows):
+		fields = self.fields
+		# default=str writes times the way the database stores them
+		lines = (json.dumps(dict(zip(fields, row)), default=str) for row in rows)
+		self._open().write("\n".join(lines) + "\n")
+
+	def _write_parquet(self, rows):
+		columns = list(zip(*rows))
+		if self._writer is None:
+			types = self.types or {}
+			self.types = {field: types.get(field) or _infer_type(values) for field, values in zip(self.fields, columns)}
+			pa_types = {"str": pyarrow.string(), "int": pyarrow.int64(), "float": pyarrow.float64(), "bool": pyarrow.bool_(), "datetime": pyarrow.timestamp("us")}
+			self._schema = pyarrow.schema([(field, pa_types[self.types[field]]) for field in self.fields])
+			self._writer = pyarrow.parquet.ParquetWriter(self.path, self._schema)
+		arrays = []
+		for field, values in zip(self._schema, columns):
+			if self.types[field.name] == "str":
+				values = [None if value is None else str(value) for value in values]
+			array = pyarrow.array(values)
+			# whole-column casts, eg 1/0 to booleans and text to times
+			arrays.append(array if array.type == field.type else array.cast(field.type))
+		self._writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self._schema))
+
+def _batches(rows, size):
+	iterator = iter(rows)
+	while True:
+		batch = list(itertools.islice(iterator, size))
+		if not batch:
+			return
+		yield batch
+
+def export_resources(path, format=None, query=None, fields=None, batch_size=10000):
+	"""Writes Resources records to a CSV, JSON Lines or Parquet file and returns the number written. Rows are read from a database cursor batch_size at a time, so any number can be exported.
+	Values are written as the database stores them, without making a model object for every row: in CSV and JSON Lines, booleans are 1 or 0 and times are text. Parquet columns get their proper types.
+	Needs the downloader's database started first (downloader.start_database).
+	...
+	Parameters
+	----------
+	path : str
+		File to write. A CSV or JSON Lines file that already exists is added to.
+	format : str, optional
+		"csv", "jsonl" or "parquet". Default is None: taken from the extension of path.
+	query : peewee query, optional
+		Query on Resources choosing the records, eg Resources.select().where(Resources.download_status == True). Default is None: every record, in id order.
+	fields : list of str, optional
+		Fields to write, in order. Default is None: the fields selected by query, which is every field of Resources unless it selects fewer.
+	batch_size : int, optional
+		Number of records written at a time. Default is 10000.
+	"""
+	if downloader.database.deferred:
+		raise ValueError("No database started - call downloader.start_database with the database to export first")
+	model_fields = downloader.Resources._meta.fields
+	if query is None:
+		query = downloader.Resources.select().order_by(downloader.Resources.id)
+	if fields is not None:
+		query = query.select(*[model_fields[name] for name in fields])
+	cursor = downloader.database.execute(query)
+	fields = [column[0] for column in cursor.description]
+	types = {name: PEEWEE_TYPES.get(field.field_type, "str") for name, field in model_fields.items()}
+	with RecordSink(path, format, fields=fields, batch_size=batch_size, types=types) as sink:
+		# the cursor hands rows over as SQLite reads them, so the result is never held in memory
+		while True:
+			rows = cursor.fetchmany(batch_size)
+			if not rows:
+				break
+			sink.add_rows(rows)
+	return sink.count
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Export the Resources table of a downloader database to CSV, JSON Lines or Parquet.")
+	parser.add_argument("database", help="downloader database, eg files_from_urls.db")
+	parser.add_argument("output", help="file to write: .csv, .jsonl or .parquet")
+	parser.add_argument("--format", choices=["csv", "jsonl", "parquet"], help="format, if not clear from the output filename")
+	parser.add_argument("--downloaded-only", action="store_true", help="only export records whose download succeeded")
+	args = parser.parse_args(argv)
+
+	downloader.start_database(args.database)
+	query = downloader.Resources.select().order_by(downloader.Resources.id)
+	if args.downloaded_only:
+		query = query.where(downloader.Resources.download_status == True)
+	count = export_resources(args.output, args.format, query)
+	print(f"Exported {count} records to '{args.output}'")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,63 @@
+#! /usr/bin/env python3
+
+"""
+Module to share one pooled HTTP session between downloads.
+
+A new requests.Session for every URL means a fresh TCP and TLS handshake every time, and keep-alive connections are never reused. The downloaders instead take a session that is created once and shared by every DownloadResource. Batches against the same few hosts then reuse connections that are already open. The shared session doesn't keep cookies, so nothing piles up over a long run and no download is sent cookies set for another; cookies set during the redirects of one request are still sent on to the next hop.
+
+Function "get_session" returns the shared session, creating it with the default pool sizes the first time it is called.
+
+Function "start_session" replaces the shared session with one using the pool sizes of your choosing. Function "make_session" builds a separate pooled session if you would rather pass your own to the downloaders.
+
+"""
+
+from http.cookiejar import DefaultCookiePolicy
+import requests # req
+from requests.adapters import HTTPAdapter
+import threading
+
+def make_session(pool_connections=10, pool_maxsize=10, max_retries=0, keep_cookies=False):
+	"""Makes a requests.Session whose connection pools are sized for downloading many resources.
+	...
+	Parameters
+	----------
+	pool_connections : int, optional
+		Number of hosts to keep a connection pool open for. Default is 10.
+	pool_maxsize : int, optional
+		Number of connections kept open to each host. Should be at least the number of downloads you run against one host at a time. Default is 10.
+	max_retries : int, optional
+		Number of times urllib3 retries a failed connection before giving up. Default is 0.
+	keep_cookies : bool, optional
+		Set to True to keep the cookies servers set in the session and send them with later requests, as a browser would. Default is False: every request starts without cookies, as it did with a new session per URL.
+	"""
+	session = requests.Session()
+	if not keep_cookies:
+		# no allowed domains, so the session's jar refuses every cookie
+		session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+	adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=max_retries)
+	session.mount("http://", adapter)
+	session.mount("https://", adapter)
+	return session
+
+_session = None
+_session_lock = threading.Lock()
+
+def start_session(pool_connections=10, pool_maxsize=10, max_retries=0, keep_cookies=False):
+	"""Replaces the shared session used by the downloaders with a new one. Takes the same parameters as make_session.
+	"""
+	global _session
+	with _session_lock:
+		old_session = _session
+		_session = make_session(pool_connections, pool_maxsize, max_retries, keep_cookies)
+	if old_session is not None:
+		old_session.close()
+	return _session
+
+def get_session():
+	"""Returns the shared session, creating it with the default pool sizes if it doesn't exist yet
+	"""
+	global _session
+	with _session_lock:
+		if _session is None:
+			_session = make_session()
+		return _session
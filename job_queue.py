@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+
+"""
+Module to keep a list of URLs to download as a queue in the database, so a batch that is interrupted can carry on where it stopped.
+
+Class "Jobs" is the queue table. Each URL of a batch has a row holding its position in the list and its state: pending, in_progress, done or failed. It also keeps the number of attempts made, who is working on it and until when, and the Resources id it ended up with.
+
+Class "JobQueue" adds a list to the queue once and hands its jobs out to workers. A worker claims a job with a lease, which it keeps renewing while it is alive; if the process dies, the lease runs out and the job is handed out again. A job that keeps killing its worker is given up on after max_attempts.
+
+"downloader.download_from_list" uses this when given a job_batch name, but the queue can be used on its own:
+
+	queue = job_queue.JobQueue(downloader.database, "gazette-2022")
+	queue.enqueue(urls)
+	queue.counts()
+
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import logging
+import os
+import peewee
+import socket
+import threading
+import time
+import uuid
+
+PENDING = "pending"
+IN_PROGRESS = "in_progress"
+DONE = "done"
+FAILED = "failed"
+
+# rows written per statement when adding a list to the queue
+INSERT_CHUNK = 500
+
+class Jobs(peewee.Model):
+	"""Creates the queue table. Bound to a database by JobQueue.
+	...
+
+	Database fields
+	----------
+		batch : str
+			Name of the list the job belongs to
+		position : int
+			Position of the URL in the list, starting at 0
+		url : str
+			URL to download
+		state : str
+			"pending", "in_progress", "done" or "failed"
+		attempts : int
+			Number of times the job has been handed to a worker
+		lease_owner : str
+			Worker holding the job while it is in progress
+		lease_expires : float
+			Unix time at which the job can be handed to another worker if it still isn't finished
+		resource_id : int
+			id of the Resources record made for the job
+		message : str
+			Message of that record, or why the job was given up on
+		updated : datetime
+			Time the job last changed state
+	"""
+
+	batch = peewee.CharField(max_length=100)
+	position = peewee.IntegerField()
+	url = peewee.CharField(max_length=300)
+	state = peewee.CharField(max_length=20, default=PENDING)
+	attempts = peewee.IntegerField(default=0)
+	lease_owner = peewee.CharField(max_length=100, null=True, default=None)
+	lease_expires = peewee.FloatField(null=True, default=None)
+	resource_id = peewee.IntegerField(null=True, default=None)
+	message = peewee.CharField(max_length=300, null=True, default=None)
+	updated = peewee.DateTimeField(null=True, default=None)
+
+	class Meta:
+		indexes = (
+			(("batch", "position"), True),
+			(("batch", "state", "position"), False),
+		)
+
+def new_owner_name():
+	"""Makes a name for a worker that is unique across machines, processes and runs
+	"""
+	return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class JobQueue:
+	"""Hands out the jobs of one batch in the queue table, creating the table if it doesn't exist.
+	...
+	Parameters
+	----------
+	database : peewee.Database
+		Database to keep the queue in, eg downloader.database once started
+	batch : str
+		Name of the list. Adding the same list under the same name again doesn't add it twice.
+	lease_seconds : float, optional
+		How long a worker can hold a job before it is handed out again, in seconds. Should be longer than the slowest download, unless the worker renews its leases with keep_leases. Default is 3600.
+	max_attempts : int, optional
+		Number of times a job can be handed out without being finished or released - ie its worker died and its lease ran out - before it is marked failed. Default is 3.
+
+	METHODS
+	-------
+
+	enqueue
+	claim
+	renew
+	keep_leases
+	wait_for_others
+	finish
+	finish_many
+	release
+	retry_failed
+	counts
+	results
+	"""
+
+	def __init__(self, database, batch, lease_seconds=3600, max_attempts=3):
+		self.database = database
+		self.batch = batch
+		self.lease_seconds = lease_seconds
+		self.max_attempts = max_attempts
+		Jobs.bind(database)
+		database.create_tables([Jobs], safe=True)
+
+	def _jobs(self):
+		return Jobs.select().where(Jobs.batch == self.batch)
+
+	def enqueue(self, urls, lookup_existing=None):
+		"""Adds urls to the batch in order, skipping any position already in it, and returns the number added. The URLs are read and written in chunks, so any number can be added.
+		...
+		Parameters
+		----------
+		urls : iterable of str
+			URLs in the order they should be downloaded
+		lookup_existing : function, optional
+			Called with each URL, returns the Resources id if it has already been downloaded, else None. Those jobs are added as done.
+		"""
+		now = datetime.now()
+		chunk = []
+
+		def insert(rows):
+			# positions already in the batch are left as they are
+			with self.database.atomic():
+				Jobs.insert_many(rows).on_conflict_ignore().execute()
+
+		before = self._jobs().count()
+		for position, url in enumerate(urls):
+			row = {"batch": self.batch, "position": position, "url": url, "state": PENDING, "updated": now}
+			existing_id = lookup_existing(url) if lookup_existing is not None else None
+			if existing_id is not None:
+				row.update(state=DONE, resource_id=existing_id, message="Already downloaded")
+			chunk.append(row)
+			if len(chunk) >= INSERT_CHUNK:
+				insert(chunk)
+				chunk = []
+		if chunk:
+			insert(chunk)
+		added = self._jobs().count() - before
+		if added:
+			logging.info(f"Added {added} URLs to job batch '{self.batch}'")
+		return added
+
+	def claim(self, owner, count=1):
+		"""Hands up to count jobs to owner, in list order, and returns them. Takes pending jobs and in-progress jobs whose lease has run out. Returns an empty list when there is nothing left to hand out.
+		Jobs whose lease has already run out max_attempts times are marked failed instead.
+		"""
+		now = time.time()
+		claimable = (Jobs.state == PENDING) | ((Jobs.state == IN_PROGRESS) & (Jobs.lease_expires < now))
+		# IMMEDIATE takes the write lock first, so two workers can't claim the same job
+		with self.database.atomic("IMMEDIATE"):
+			exhausted = (Jobs
+				.update(state=FAILED, lease_owner=None, lease_expires=None, updated=datetime.now(), message=f"Gave up after {self.max_attempts} attempts")
+				.where((Jobs.batch == self.batch) & claimable & (Jobs.attempts >= self.max_attempts))
+				.execute())
+			if exhausted:
+				logging.warning(f"Gave up on {exhausted} job(s) in batch '{self.batch}' after {self.max_attempts} attempts")
+			jobs = list(self._jobs().where(claimable).order_by(Jobs.position).limit(count))
+			if jobs:
+				(Jobs
+					.update(state=IN_PROGRESS, attempts=Jobs.attempts + 1, lease_owner=owner, lease_expires=now + self.lease_seconds, updated=datetime.now())
+					.where(Jobs.id.in_([job.id for job in jobs]))
+					.execute())
+		for job in jobs:
+			job.state, job.attempts, job.lease_owner = IN_PROGRESS, job.attempts + 1, owner
+		return jobs
+
+	def renew(self, owner):
+		"""Pushes back the lease of every job owner holds to lease_seconds from now, and returns how many there were
+		"""
+		return (Jobs
+			.update(lease_expires=time.time() + self.lease_seconds)
+			.where((Jobs.batch == self.batch) & (Jobs.state == IN_PROGRESS) & (Jobs.lease_owner == owner))
+			.execute())
+
+	@contextmanager
+	def keep_leases(self, owner, interval=None):
+		"""Renews owner's leases on a background thread every interval seconds for the duration of the with block, so a short lease_seconds can be used: jobs are only handed out again once the owner has stopped renewing them, eg because its process died.
+		Default interval is a quarter of lease_seconds.
+		"""
+		interval = interval or self.lease_seconds / 4
+		stop = threading.Event()
+
+		def keep_renewing():
+			try:
+				while not stop.wait(interval):
+					try:
+						self.renew(owner)
+					except peewee.OperationalError as e:
+						logging.warning(f"Could not renew the leases of job batch '{self.batch}': {e}")
+			finally:
+				# the thread has its own connection
+				self.database.close()
+
+		thread = threading.Thread(target=keep_renewing, name="job-leases", daemon=True)
+		thread.start()
+		try:
+			yield
+		finally:
+			stop.set()
+			thread.join()
+
+	def wait_for_others(self, owner, poll_seconds=5):
+		"""Returns False straight away if no owner but this one holds jobs of the batch. Otherwise waits until the first of their leases runs out, or poll_seconds at most, and returns True so the caller can claim again: any job whose owner has stopped renewing it is handed out once its lease has run out.
+		"""
+		query = Jobs.select().where((Jobs.batch == self.batch) & (Jobs.state == IN_PROGRESS) & (Jobs.lease_owner != owner))
+		held = query.count()
+		if not held:
+			return False
+		first_expiry = query.select(peewee.fn.MIN(Jobs.lease_expires)).scalar()
+		logging.info(f"Waiting for {held} job(s) in batch '{self.batch}' held by other runs")
+		time.sleep(min(max((first_expiry or 0) - time.time(), 0), poll_seconds))
+		return True
+
+	def finish(self, job, record):
+		"""Marks a job done or failed from the download_status of its Resources record, which must already be saved
+		"""
+		self.finish_many([(job, record)])
+
+	def finish_many(self, finished):
+		"""Marks several jobs done or failed from their saved Resources records, in one transaction
+		...
+		Parameters
+		----------
+		finished : iterable of (job or job id, Resources record) pairs
+		"""
+		now = datetime.now()
+		with self.database.atomic():
+			for job, record in finished:
+				job_id = job.id if isinstance(job, Jobs) else job
+				(Jobs
+					.update(state=DONE if record.download_status else FAILED, resource_id=record.id, message=record.message, lease_owner=None, lease_expires=None, updated=now)
+					.where(Jobs.id == job_id)
+					.execute())
+
+	def release(self, owner):
+		"""Puts the jobs owner still holds back to pending, eg when a run is stopped, so the next run doesn't wait for their leases to run out.
+		Gives back the attempt each was handed out with, as only a worker dying counts against max_attempts.
+		"""
+		return (Jobs
+			.update(state=PENDING, attempts=Jobs.attempts - 1, lease_owner=None, lease_expires=None, updated=datetime.now())
+			.where((Jobs.batch == self.batch) & (Jobs.state == IN_PROGRESS) & (Jobs.lease_owner == owner))
+			.execute())
+
+	def retry_failed(self):
+		"""Puts every failed job in the batch back to pending with its attempts reset, and returns how many there were
+		"""
+		return (Jobs
+			.update(state=PENDING, attempts=0, updated=datetime.now())
+			.where((Jobs.batch == self.batch) & (Jobs.state == FAILED))
+			.execute())
+
+	def counts(self):
+		"""Returns a dictionary of state to number of jobs in the batch
+		"""
+		query = (Jobs
+			.select(Jobs.state, peewee.fn.COUNT(Jobs.id))
+			.where(Jobs.batch == self.batch)
+			.group_by(Jobs.state)
+			.tuples())
+		return {state: count for state, count in query}
+
+	def results(self):
+		"""Yields (position, url, resource_id) for every job in the batch in list order, without holding them all in memory. resource_id is None for jobs not finished.
+		"""
+		query = (Jobs
+			.select(Jobs.position, Jobs.url, Jobs.resource_id)
+			.where(Jobs.batch == self.batch)
+			.order_by(Jobs.position)
+			.tuples())
+		yield from query.iterator()
@@ -0,0 +1,56 @@
+#! /usr/bin/env python3
+
+"""
+Module to spread downloaded files over subdirectories, so no single directory ends up holding millions of files.
+
+Class "ShardedLayout" works out the subdirectory a file goes in from the first characters of its UUID filename or of its hash, eg "content/3f/a2/3fa27c1e-....pdf" with the default two levels of two characters. Two levels of two hex characters make 65,536 subdirectories, each holding about 1/65,536th of the files. Pass one to either downloader as layout. Files are still downloaded into the directory itself, where the ".part" file of an unfinished download is found again by the next attempt, and are moved into their subdirectory once finished. The filepath and directory stored for each file include its subdirectory.
+
+"""
+
+import os
+
+class ShardedLayout:
+	"""Places each downloaded file in nested subdirectories named after the start of its UUID filename or its hash.
+	...
+	Parameters
+	----------
+	key : str, optional
+		"uuid" to shard by the UUID filename. "hash" to shard by a hash of the content, so identical files end up side by side. Default is "uuid".
+	levels : int, optional
+		Number of nested subdirectories. Default is 2.
+	width : int, optional
+		Number of characters of the key naming each subdirectory. Default is 2.
+	hash_name : str, optional
+		Only used with key="hash". Hash to shard by, from "md5", "sha1" and "sha256". Must be one of the hashes being computed. Default is "md5".
+
+	METHODS
+	-------
+
+	subdirectory
+	place
+	"""
+
+	def __init__(self, key="uuid", levels=2, width=2, hash_name="md5"):
+		if key not in ("uuid", "hash"):
+			raise ValueError(f"Unknown layout key '{key}'")
+		self.key = key
+		self.levels = levels
+		self.width = width
+		self.hash_name = hash_name
+
+	def subdirectory(self, filename, digests=None):
+		"""Returns the relative subdirectory for a file, eg "3f/a2", from its UUID filename or, with key="hash", from digests (a dictionary of hash name to hex digest)
+		"""
+		if self.key == "hash":
+			name = digests[self.hash_name]
+		else:
+			# hyphens in the UUID would give unevenly filled directories
+			name = filename.replace("-", "")
+		parts = [name[level * self.width:(level + 1) * self.width] for level in range(self.levels)]
+		return os.path.join(*parts) if parts else ""
+
+	def place(self, directory, filename, digests=None):
+		"""Returns the directory the file belongs in under directory
+		"""
+		subdirectory = self.subdirectory(filename, digests)
+		return os.path.join(directory, subdirectory) if subdirectory else directory
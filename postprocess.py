@@ -0,0 +1,129 @@
+#! /usr/bin/env python3
+
+"""
+Module to run the work done on a file after it has been downloaded away from the threads doing the downloading.
+
+Function "read_metadata" finds the file type and MIME type of a downloaded file, recognising common formats from their first bytes and running ExifTool on the rest.
+
+Class "PostProcessor" runs read_metadata on a pool of processes and then finishes the DownloadResource - rejecting web pages, adding the file extension and handing over the record - on a few threads of its own as soon as the metadata comes back. Pass one to "downloader.download_from_list" as post_processor so a slow ExifTool call never holds up the next download. Only a bounded number of files can wait for post-processing at once: when that many are waiting, the downloading threads wait too, so neither side can run away from the other.
+
+Scripts using a PostProcessor with processes should start from an "if __name__ == '__main__':" block, as the worker processes import the main module when they start.
+
+"""
+
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import exiftool_pool
+import multiprocessing
+import os
+from sniffer import sniff_filetype
+import threading
+import time
+
+def read_metadata(filepath, prefix=b"", full_metadata=False):
+	"""Returns a dictionary of metadata for a downloaded file, with at least 'File:FileTypeExtension' and 'File:MIMEType' if the type is known.
+	...
+	Parameters
+	----------
+	filepath : str
+		Path of the downloaded file
+	prefix : bytes, optional
+		First few KB of the file, if already read. Common file types are recognised from these without running ExifTool.
+	full_metadata : bool, optional
+		Set to True to always run ExifTool and return everything it reports. Default is False.
+	"""
+	sniffed = None if full_metadata else sniff_filetype(prefix)
+	if sniffed is not None:
+		return {'File:FileTypeExtension': sniffed[0], 'File:MIMEType': sniffed[1]}
+	# shared pool of running ExifTool processes - use exiftool_pool.start_pool to set the path to exiftool.exe
+	return exiftool_pool.get_metadata(filepath)
+
+def _timed_read_metadata(filepath, prefix, full_metadata):
+	"""Runs read_metadata in a worker, returning (metadata, seconds taken) so the time spent can be added to the download's timings
+	"""
+	started = time.perf_counter()
+	metadata = read_metadata(filepath, prefix, full_metadata)
+	return metadata, time.perf_counter() - started
+
+class PostProcessor:
+	"""Reads the metadata of downloaded files on a pool of worker processes and finishes each DownloadResource when its metadata is ready.
+	Can be used as a context manager, which waits for the work in hand and shuts the pool down on exit.
+	...
+	Parameters
+	----------
+	workers : int, optional
+		Number of worker processes (or threads). Default is None: the number of CPUs.
+	queue_size : int, optional
+		Most files that can be waiting for or in post-processing at once. Downloads that finish while it is full wait for a place. Default is None: four per worker.
+	processes : bool, optional
+		Set to False to use threads instead of processes, eg when ExifTool is doing most of the work in its own processes anyway. Default is True.
+	executable : str, optional
+		Path to the ExifTool executable for the worker processes, if it is not on the path. Each worker process runs one ExifTool process of its own. With threads, the shared pool in exiftool_pool.py is used instead.
+	finish_threads : int, optional
+		Number of threads finishing resources once their metadata is back: renaming the file, checking the content store and handing over the record, which can mean writing a batch of records. Default is 2.
+
+	METHODS
+	-------
+
+	submit
+	shutdown
+	"""
+
+	def __init__(self, workers=None, queue_size=None, processes=True, executable=None, finish_threads=2):
+		self.workers = workers or os.cpu_count() or 1
+		self.queue_size = queue_size or self.workers * 4
+		if processes:
+			# spawn rather than fork: forking a process that is running download threads can copy a lock that is held
+			self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=exiftool_pool.start_pool, initargs=(1, 16, executable))
+		else:
+			self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="postprocess")
+		# done-callbacks of a process pool run on the thread that hands out its work, so the finishing is passed on to threads of its own
+		self._finisher = ThreadPoolExecutor(max_workers=finish_threads, thread_name_prefix="postprocess-finish")
+		self._places = threading.BoundedSemaphore(self.queue_size)
+
+	def submit(self, resource):
+		"""Queues a downloaded DownloadResource for post-processing, waiting for a place if the queue is full.
+		Returns a Future whose result is the resource once get_file_metadata and finish have run on it, or whose exception is whatever stopped them.
+		"""
+		self._places.acquire()
+		finished = Future()
+
+		def complete(future):
+			# runs on one of the finishing threads once the worker is done
+			try:
+				metadata, seconds = future.result()
+				resource.timer.add("metadata", seconds)
+				resource.get_file_metadata(metadata)
+				resource.finish()
+			except BaseException as e:
+				finished.set_exception(e)
+			else:
+				finished.set_result(resource)
+			finally:
+				self._places.release()
+
+		def hand_over(future):
+			try:
+				self._finisher.submit(complete, future)
+			except BaseException as e:
+				# the finishing threads have been shut down
+				finished.set_exception(e)
+				self._places.release()
+
+		try:
+			future = self._executor.submit(_timed_read_metadata, resource.filepath, resource.prefix, resource.full_metadata)
+		except BaseException:
+			self._places.release()
+			raise
+		future.add_done_callback(hand_over)
+		return finished
+
+	def shutdown(self, wait=True):
+		self._executor.shutdown(wait=wait)
+		# every result is handed over by now if waiting, so the finishing threads get all their work before they stop
+		self._finisher.shutdown(wait=wait)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.shutdown()
@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+
+"""
+Module to keep requests to each host at a polite rate.
+
+Class "RateLimiter" holds a token bucket for every host it sees. A download waits for a token from its host's bucket before making a request, so each origin is held to its own rate while requests to other hosts carry on. A 429 or 503 response with a 'Retry-After' header pauses every request to that host until the time it gives, even with no rate limit, and the downloaders ask for the throttled URL again once the pause is over.
+
+Function "get_limiter" returns the limiter shared by all downloads, creating it with the default rate the first time it is called. Function "start_limiter" replaces it with one using the rates of your choosing.
+
+"""
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+class TokenBucket:
+	"""Lets through at most rate requests per second on average, with bursts of up to burst requests.
+	...
+	Parameters
+	----------
+	rate : float
+		Requests allowed per second. 0 or None means no limit.
+	burst : int, optional
+		Number of requests that can go straight through after a quiet spell. Default is 1.
+	"""
+
+	def __init__(self, rate, burst=1):
+		self.rate = rate
+		self.capacity = burst
+		self.tokens = burst
+		self.updated = time.monotonic()
+		self.paused_until = 0
+		self._lock = threading.Lock()
+
+	def acquire(self):
+		"""Takes a token, sleeping until one is available and any pause is over
+		"""
+		with self._lock:
+			now = time.monotonic()
+			if not self.rate:
+				# no rate limit, but a 'Retry-After' pause still holds
+				wait = self.paused_until - now
+			else:
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+				# tokens can go below zero: each waiting caller has reserved its place in the queue
+				self.tokens -= 1
+				wait = max(-self.tokens / self.rate, self.paused_until - now, 0)
+		if wait > 0:
+			time.sleep(wait)
+
+	def pause(self, seconds):
+		"""Holds back every request until seconds from now
+		"""
+		with self._lock:
+			self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class RateLimiter:
+	"""Keeps a token bucket per host, shared by every download that uses this limiter.
+	...
+	Parameters
+	----------
+	rate : float, optional
+		Requests per second allowed to any one host. Default is 2, the same pace as the half-second pause the downloader used to take after every resource. 0 or None means no limit.
+	burst : int, optional
+		Number of requests to a host that can go straight through after a quiet spell. Default is 1.
+	host_rates : dict, optional
+		Requests per second for particular hosts, eg {"gazette.govt.nz": 0.5}, overriding rate.
+	max_pause : float, optional
+		Longest 'Retry-After' pause to honour, in seconds. Default is 600.
+	retries : int, optional
+		Number of times the downloaders make a request again after it was answered 429 or 503 with a 'Retry-After' header, waiting out the pause each time. Default is 2.
+
+	METHODS
+	-------
+
+	wait
+	pause
+	check_response
+	"""
+
+	def __init__(self, rate=2, burst=1, host_rates=None, max_pause=600, retries=2):
+		self.rate = rate
+		self.burst = burst
+		self.host_rates = {host.lower(): host_rate for host, host_rate in (host_rates or {}).items()}
+		self.max_pause = max_pause
+		self.retries = retries
+		self._buckets = {}
+		self._lock = threading.Lock()
+
+	def _bucket(self, url):
+		host = urlparse(url.strip()).netloc.lower()
+		with self._lock:
+			if host not in self._buckets:
+				self._buckets[host] = TokenBucket(self.host_rates.get(host, self.rate), self.burst)
+			return self._buckets[host]
+
+	def wait(self, url):
+		"""Sleeps until a request to the host of url is allowed
+		"""
+		self._bucket(url).acquire()
+
+	def pause(self, url, seconds):
+		"""Holds back every request to the host of url for the given number of seconds, up to max_pause, and returns the seconds paused
+		"""
+		seconds = min(seconds, self.max_pause)
+		logging.warning(f"Pausing requests to {urlparse(url).netloc} for {seconds:.0f}s")
+		self._bucket(url).pause(seconds)
+		return seconds
+
+	def check_response(self, response):
+		"""Pauses the response's host if it answered 429 Too Many Requests or 503 Service Unavailable with a 'Retry-After' header.
+		Returns the seconds paused, or None if the response didn't ask for a pause - so a caller can tell whether the request is worth making again once wait allows it.
+		"""
+		if response.status_code not in (429, 503):
+			return None
+		seconds = _retry_after_seconds(response.headers.get("Retry-After"))
+		if seconds is None:
+			return None
+		return self.pause(response.url, seconds)
+
+def _retry_after_seconds(value):
+	"""Turns a 'Retry-After' header, either a number of seconds or an HTTP date, into seconds from now. Returns None if it can't be read.
+	"""
+	if value is None:
+		return None
+	value = value.strip()
+	if value.isdigit():
+		return int(value)
+	try:
+		retry_at = parsedate_to_datetime(value)
+	except (TypeError, ValueError):
+		return None
+	if retry_at.tzinfo is None:
+		retry_at = retry_at.replace(tzinfo=timezone.utc)
+	return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def start_limiter(rate=2, burst=1, host_rates=None, max_pause=600, retries=2):
+	"""Replaces the shared limiter used by the downloaders with a new one. Takes the same parameters as RateLimiter.
+	"""
+	global _limiter
+	with _limiter_lock:
+		_limiter = RateLimiter(rate, burst, host_rates, max_pause, retries)
+		return _limiter
+
+def get_limiter():
+	"""Returns the shared limiter, creating it with the default rate if it doesn't exist yet
+	"""
+	global _limiter
+	with _limiter_lock:
+		if _limiter is None:
+			_limiter = RateLimiter()
+		return _limiter
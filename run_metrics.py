@@ -0,0 +1,338 @@
+#! /usr/bin/env python3
+
+"""
+Module to watch a long batch of downloads while it runs.
+
+Class "RunMetrics" counts what a batch is doing: downloads in flight, finished and failed downloads by type of message, bytes and bytes/s, latency histograms and rolling percentiles, and the same counts per host. Pass one to "downloader.download_from_list" as metrics and it is updated as each download starts and finishes.
+
+The counts can be read in the Prometheus text format, either from a file written with "write_textfile" (eg for node_exporter's textfile collector) or from a local HTTP endpoint started with "serve". "start_reporting" also logs a progress line every so often, with a warning if nothing has finished for a whole interval while downloads are in flight.
+
+Example:
+
+	metrics = run_metrics.RunMetrics()
+	metrics.serve(9100)
+	metrics.start_reporting(interval=60, textfile="downloads.prom")
+	downloader.download_from_list(urls, max_workers=8, metrics=metrics)
+	metrics.stop()
+
+"""
+
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def _message_type(download_status, message):
+	"""Groups download messages into a few types for counting, eg "Download interrupted: <error>" becomes "Download interrupted". HTTP errors keep their status code.
+	"""
+	if message is None:
+		return "ok" if download_status else "no message"
+	if message.startswith("HTTPError"):
+		return message
+	return re.split(r": | - file is from record", message)[0]
+
+def _host(url):
+	return urlparse(url.strip()).netloc.lower()
+
+def _escape(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(**labels):
+	return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+def _percentile(values, fraction):
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def _format_duration(seconds):
+	minutes, seconds = divmod(int(seconds), 60)
+	hours, minutes = divmod(minutes, 60)
+	return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+class RunMetrics:
+	"""Counts the downloads of a batch as they start and finish. Safe to update from several threads at once.
+	...
+	Parameters
+	----------
+	window : float, optional
+		Seconds of recent downloads used for the rolling bytes/s, URLs/s and latency percentiles. Default is 60.
+
+	METHODS
+	-------
+
+	expect
+	skipped
+	started
+	finished
+	record
+	render
+	write_textfile
+	serve
+	progress_line
+	start_reporting
+	stop
+	"""
+
+	def __init__(self, window=60):
+		self.window = window
+		self.started_at = time.monotonic()
+		self.expected = 0
+		self.skipped_count = 0
+		self.in_flight = 0
+		self.bytes_total = 0
+		# (result, message type) -> count
+		self.results = {}
+		self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+		self.latency_sum = 0.0
+		# (time finished, bytes, seconds taken) for downloads finished within the window
+		self.recent = deque()
+		self.hosts = {}
+		self.last_finished_at = None
+		self._lock = threading.Lock()
+		self._server = None
+		self._reporter = None
+		self._reporter_settings = None
+		self._stop_reporting = threading.Event()
+
+	def _host_stats(self, host):
+		if host not in self.hosts:
+			self.hosts[host] = {"in_flight": 0, "done": 0, "failed": 0, "bytes": 0}
+		return self.hosts[host]
+
+	def _prune(self, now):
+		while self.recent and self.recent[0][0] < now - self.window:
+			self.recent.popleft()
+
+	def expect(self, count):
+		"""Adds count URLs to the number the batch is expected to download, for progress and time remaining
+		"""
+		with self._lock:
+			self.expected += count
+
+	def skipped(self, count):
+		"""Counts URLs left out of the batch because they were already downloaded
+		"""
+		with self._lock:
+			self.skipped_count += count
+
+	def started(self, url):
+		"""Marks a download of url as in flight
+		"""
+		with self._lock:
+			self.in_flight += 1
+			self._host_stats(_host(url))["in_flight"] += 1
+
+	def finished(self, url, download_status, message=None, bytes_transferred=None, seconds=None):
+		"""Marks a download of url started with "started" as finished, counting its result, message type, bytes and time taken
+		"""
+		now = time.monotonic()
+		result = "done" if download_status else "failed"
+		message_type = _message_type(download_status, message)
+		with self._lock:
+			self.in_flight -= 1
+			host_stats = self._host_stats(_host(url))
+			host_stats["in_flight"] -= 1
+			host_stats[result] += 1
+			host_stats["bytes"] += bytes_transferred or 0
+			self.results[(result, message_type)] = self.results.get((result, message_type), 0) + 1
+			self.bytes_total += bytes_transferred or 0
+			if seconds is not None:
+				bucket = next((number for number, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+				self.latency_counts[bucket] += 1
+				self.latency_sum += seconds
+			self.recent.append((now, bytes_transferred or 0, seconds))
+			self._prune(now)
+			self.last_finished_at = now
+
+	def record(self, resource):
+		"""Calls "finished" with the outcome of a DownloadResource from either downloader
+		"""
+		self.finished(resource.url_original, resource.download_status, resource.message, getattr(resource, "bytes_transferred", None), resource.timer.total())
+
+	def _snapshot(self):
+		"""Copies the counts under the lock, with the rolling rates and percentiles worked out, so they can be formatted without holding it
+		"""
+		now = time.monotonic()
+		with self._lock:
+			self._prune(now)
+			recent = list(self.recent)
+			snapshot = {
+				"elapsed": now - self.started_at,
+				"expected": self.expected,
+				"skipped": self.skipped_count,
+				"in_flight": self.in_flight,
+				"bytes_total": self.bytes_total,
+				"results": dict(self.results),
+				"latency_counts": list(self.latency_counts),
+				"latency_sum": self.latency_sum,
+				"hosts": {host: dict(stats) for host, stats in self.hosts.items()},
+				"idle": now - (self.last_finished_at if self.last_finished_at is not None else self.started_at),
+			}
+		# a run younger than the window is measured over its own length
+		span = min(self.window, snapshot["elapsed"]) or 1
+		latencies = [seconds for _, _, seconds in recent if seconds is not None]
+		snapshot["finished"] = sum(snapshot["results"].values())
+		snapshot["failed"] = sum(count for (result, _), count in snapshot["results"].items() if result == "failed")
+		snapshot["bytes_per_second"] = sum(bytes_transferred for _, bytes_transferred, _ in recent) / span
+		snapshot["urls_per_second"] = len(recent) / span
+		snapshot["latency_p50"] = _percentile(latencies, 0.5) if latencies else None
+		snapshot["latency_p99"] = _percentile(latencies, 0.99) if latencies else None
+		return snapshot
+
+	def render(self):
+		"""Returns the metrics in the Prometheus text format
+		"""
+		snapshot = self._snapshot()
+		lines = [
+			"# HELP downloader_urls_expected URLs the run is expected to download",
+			"# TYPE downloader_urls_expected gauge",
+			f"downloader_urls_expected {snapshot['expected']}",
+			"# HELP downloader_urls_skipped_total URLs skipped because they were already downloaded",
+			"# TYPE downloader_urls_skipped_total counter",
+			f"downloader_urls_skipped_total {snapshot['skipped']}",
+			"# HELP downloader_in_flight Downloads currently running",
+			"# TYPE downloader_in_flight gauge",
+			f"downloader_in_flight {snapshot['in_flight']}",
+			"# HELP downloader_downloads_total Finished downloads by result and message type",
+			"# TYPE downloader_downloads_total counter",
+		]
+		for (result, message_type), count in sorted(snapshot["results"].items()):
+			lines.append(f"downloader_downloads_total{_labels(result=result, message_type=message_type)} {count}")
+		lines += [
+			"# HELP downloader_bytes_total Bytes received over the network",
+			"# TYPE downloader_bytes_total counter",
+			f"downloader_bytes_total {snapshot['bytes_total']}",
+			f"# HELP downloader_bytes_per_second Bytes received per second over the last {self.window:g}s",
+			"# TYPE downloader_bytes_per_second gauge",
+			f"downloader_bytes_per_second {snapshot['bytes_per_second']:.1f}",
+			f"# HELP downloader_downloads_per_second Downloads finished per second over the last {self.window:g}s",
+			"# TYPE downloader_downloads_per_second gauge",
+			f"downloader_downloads_per_second {snapshot['urls_per_second']:.3f}",
+			"# HELP downloader_latency_seconds Time taken by each download",
+			"# TYPE downloader_latency_seconds histogram",
+		]
+		cumulative = 0
+		for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), snapshot["latency_counts"]):
+			cumulative += count
+			lines.append(f"downloader_latency_seconds_bucket{_labels(le=bound)} {cumulative}")
+		lines += [
+			f"downloader_latency_seconds_sum {snapshot['latency_sum']:.3f}",
+			f"downloader_latency_seconds_count {cumulative}",
+			f"# HELP downloader_recent_latency_seconds Percentiles of the time taken by downloads finished in the last {self.window:g}s",
+			"# TYPE downloader_recent_latency_seconds gauge",
+		]
+		for quantile in ("0.5", "0.99"):
+			value = snapshot["latency_p50"] if quantile == "0.5" else snapshot["latency_p99"]
+			if value is not None:
+				lines.append(f"downloader_recent_latency_seconds{_labels(quantile=quantile)} {value:.3f}")
+		lines += [
+			"# HELP downloader_host_in_flight Downloads currently running per host",
+			"# TYPE downloader_host_in_flight gauge",
+		]
+		lines += [f"downloader_host_in_flight{_labels(host=host)} {stats['in_flight']}" for host, stats in sorted(snapshot["hosts"].items())]
+		lines += [
+			"# HELP downloader_host_downloads_total Finished downloads per host by result",
+			"# TYPE downloader_host_downloads_total counter",
+		]
+		for host, stats in sorted(snapshot["hosts"].items()):
+			lines.append(f"downloader_host_downloads_total{_labels(host=host, result='done')} {stats['done']}")
+			lines.append(f"downloader_host_downloads_total{_labels(host=host, result='failed')} {stats['failed']}")
+		lines += [
+			"# HELP downloader_host_bytes_total Bytes received per host",
+			"# TYPE downloader_host_bytes_total counter",
+		]
+		lines += [f"downloader_host_bytes_total{_labels(host=host)} {stats['bytes']}" for host, stats in sorted(snapshot["hosts"].items())]
+		return "\n".join(lines) + "\n"
+
+	def write_textfile(self, path):
+		"""Writes the metrics to path in the Prometheus text format. The file is replaced in one step, so a collector never reads half of it.
+		"""
+		temporary_path = f"{path}.{os.getpid()}.tmp"
+		with open(temporary_path, "w", encoding="utf-8") as f:
+			f.write(self.render())
+		os.replace(temporary_path, path)
+
+	def serve(self, port, address="127.0.0.1"):
+		"""Serves the metrics at http://address:port/metrics from a background thread until "stop" is called. Returns the port, which is chosen by the system if port is 0.
+		"""
+		metrics = self
+
+		class MetricsHandler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] not in ("/", "/metrics"):
+					self.send_error(404)
+					return
+				body = metrics.render().encode("utf-8")
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self._server = ThreadingHTTPServer((address, port), MetricsHandler)
+		self._server.daemon_threads = True
+		threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+		logging.info(f"Serving download metrics at http://{address}:{self._server.server_address[1]}/metrics")
+		return self._server.server_address[1]
+
+	def progress_line(self):
+		"""Returns a one-line summary of the run so far, eg "1200/40000 finished (50 failed), 8 in flight, 3.2 MB/s, 12.5 URLs/s, p50 0.80s, p99 5.10s, 52m10s left"
+		"""
+		snapshot = self._snapshot()
+		line = f"{snapshot['finished']}/{snapshot['expected'] or '?'} finished ({snapshot['failed']} failed), {snapshot['in_flight']} in flight, {snapshot['bytes_per_second'] / (1024 * 1024):.1f} MB/s, {snapshot['urls_per_second']:.1f} URLs/s"
+		if snapshot["latency_p50"] is not None:
+			line += f", p50 {snapshot['latency_p50']:.2f}s, p99 {snapshot['latency_p99']:.2f}s"
+		remaining = snapshot["expected"] - snapshot["finished"]
+		if remaining > 0 and snapshot["urls_per_second"] > 0:
+			line += f", {_format_duration(remaining / snapshot['urls_per_second'])} left"
+		return line
+
+	def _report(self, interval, textfile):
+		while not self._stop_reporting.wait(interval):
+			self._report_once(interval, textfile)
+
+	def _report_once(self, interval, textfile):
+		logging.info(f"Progress: {self.progress_line()}")
+		snapshot = self._snapshot()
+		if snapshot["in_flight"] and snapshot["idle"] >= interval:
+			logging.warning(f"No downloads have finished in {snapshot['idle']:.0f}s with {snapshot['in_flight']} in flight - the run may be stalled")
+		if textfile is not None:
+			self.write_textfile(textfile)
+
+	def start_reporting(self, interval=30, textfile=None):
+		"""Logs a progress line every interval seconds from a background thread until "stop" is called, and writes the metrics to textfile each time if given
+		...
+		Parameters
+		----------
+		interval : float, optional
+			Seconds between progress lines. Default is 30.
+		textfile : str, optional
+			Path of a Prometheus text file to rewrite at each interval. Default is None.
+		"""
+		self._stop_reporting.clear()
+		self._reporter = threading.Thread(target=self._report, args=(interval, textfile), name="metrics-reporter", daemon=True)
+		self._reporter_settings = (interval, textfile)
+		self._reporter.start()
+
+	def stop(self):
+		"""Stops the progress line and the HTTP endpoint, logging a last progress line and writing the text file one last time
+		"""
+		if self._reporter is not None:
+			self._stop_reporting.set()
+			self._reporter.join()
+			self._reporter = None
+			self._report_once(*self._reporter_settings)
+		if self._server is not None:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+
+"""
+Module to recognise what a download is from its headers and first few bytes, before the body is written to disk.
+
+Function "looks_like_html" decides from the 'Content-Type' header and the start of the body whether a response is a web page, so the downloaders can drop landing pages without downloading them.
+
+Function "sniff_filetype" recognises common formats (PDF, JPEG, PNG, GIF, TIFF, MP3, MP4, WAV, ZIP and Office files, HTML and others) from their magic numbers. It returns the same file extension and MIME type ExifTool would report, so ExifTool only has to be run on files it doesn't recognise.
+
+"""
+
+# tags a web page can start with, from the WHATWG MIME sniffing standard
+HTML_START_TAGS = (b"<!doctype html", b"<html", b"<head", b"<script", b"<iframe", b"<h1", b"<div", b"<font", b"<table", b"<a", b"<style", b"<title", b"<b", b"<body", b"<br", b"<p", b"<!--")
+
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+
+TAG_ENDINGS = (b" ", b">", b"\t", b"\n", b"\r", b"\x0c")
+
+def _starts_with_html_tag(prefix):
+	text = prefix.lstrip(b"\xef\xbb\xbf").lstrip().lower()
+	for tag in HTML_START_TAGS:
+		if not text.startswith(tag):
+			continue
+		# a comment can be followed by anything; other tags have to end there, so "<b" doesn't match "<bogus"
+		if tag == b"<!--" or text[len(tag):len(tag) + 1] in TAG_ENDINGS:
+			return True
+	return False
+
+def _looks_like_text(prefix):
+	# binary formats almost always have a null byte or other control characters near the start
+	return not any(byte < 0x09 or 0x0e <= byte < 0x20 for byte in prefix[:1024] if byte != 0x1b)
+
+def looks_like_html(content_type, prefix):
+	"""Returns True if a response looks like a web page.
+	The body must start with an HTML tag, or the 'Content-Type' must say HTML and the body must be text. A body recognised by sniff_filetype as another format is never rejected, so a PDF wrongly served as text/html is kept even if its first KB is all text, as in linearized PDFs.
+	...
+	Parameters
+	----------
+	content_type : str
+		'Content-Type' header of the response, or None
+	prefix : bytes
+		First few KB of the body
+	"""
+	if _starts_with_html_tag(prefix):
+		return True
+	sniffed = sniff_filetype(prefix)
+	if sniffed is not None and sniffed[0] != "HTML":
+		return False
+	media_type = (content_type or "").split(";")[0].strip().lower()
+	return media_type in HTML_CONTENT_TYPES and _looks_like_text(prefix)
+
+# (offset, magic bytes, extension, MIME type), with extensions and MIME types as ExifTool reports them with -n
+MAGIC_NUMBERS = (
+	(0, b"%PDF-", "PDF", "application/pdf"),
+	(0, b"\xff\xd8\xff", "JPG", "image/jpeg"),
+	(0, b"\x89PNG\r\n\x1a\n", "PNG", "image/png"),
+	(0, b"GIF87a", "GIF", "image/gif"),
+	(0, b"GIF89a", "GIF", "image/gif"),
+	(0, b"II*\x00", "TIF", "image/tiff"),
+	(0, b"MM\x00*", "TIF", "image/tiff"),
+	(0, b"ID3", "MP3", "audio/mpeg"),
+	(0, b"fLaC", "FLAC", "audio/flac"),
+	(0, b"OggS", "OGG", "audio/ogg"),
+	(0, b"\x1f\x8b", "GZ", "application/x-gzip"),
+	(0, b"7z\xbc\xaf\x27\x1c", "7Z", "application/x-7z-compressed"),
+	(0, b"{\\rtf", "RTF", "text/rtf"),
+)
+
+# RIFF containers say what they hold in bytes 8-12
+RIFF_TYPES = {
+	b"WAVE": ("WAV", "audio/x-wav"),
+	b"AVI ": ("AVI", "video/x-msvideo"),
+	b"WEBP": ("WEBP", "image/webp"),
+}
+
+# ISO media files give their brand in bytes 8-12, after "ftyp". HEIC, AVIF, CR3 and other brands not listed are left for ExifTool.
+FTYP_BRANDS = {
+	b"isom": ("MP4", "video/mp4"),
+	b"iso2": ("MP4", "video/mp4"),
+	b"iso4": ("MP4", "video/mp4"),
+	b"iso5": ("MP4", "video/mp4"),
+	b"iso6": ("MP4", "video/mp4"),
+	b"mp41": ("MP4", "video/mp4"),
+	b"mp42": ("MP4", "video/mp4"),
+	b"avc1": ("MP4", "video/mp4"),
+	b"dash": ("MP4", "video/mp4"),
+	b"M4V ": ("M4V", "video/x-m4v"),
+	b"M4A ": ("M4A", "audio/mp4"),
+	b"M4B ": ("M4B", "audio/mp4"),
+	b"qt  ": ("MOV", "video/quicktime"),
+	b"3gp4": ("3GP", "video/3gpp"),
+	b"3gp5": ("3GP", "video/3gpp"),
+	b"3gp6": ("3GP", "video/3gpp"),
+	b"3g2a": ("3G2", "video/3gpp2"),
+}
+
+# the first file in an Office Open XML zip is usually "[Content_Types].xml", so look for the folder names that follow it
+OFFICE_FOLDERS = (
+	(b"word/", "DOCX", "application/vnd.openxmlformats-officedocument.wordprocessingml.document"),
+	(b"xl/", "XLSX", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+	(b"ppt/", "PPTX", "application/vnd.openxmlformats-officedocument.presentationml.presentation"),
+)
+
+# sizes of the BMP info headers in use, from the original 12-byte core header to the 124-byte version 5
+BMP_HEADER_SIZES = (12, 16, 40, 52, 56, 64, 108, 124)
+
+def _is_bmp(prefix):
+	# "BM" alone would match any text starting with those letters, so check the reserved bytes are zero and the info header has a known size
+	if prefix[:2] != b"BM" or len(prefix) < 18:
+		return False
+	return prefix[6:10] == b"\x00\x00\x00\x00" and int.from_bytes(prefix[14:18], "little") in BMP_HEADER_SIZES
+
+def _sniff_zip(prefix):
+	# OpenDocument and EPUB files start with an uncompressed "mimetype" entry holding their MIME type
+	if prefix[30:38] == b"mimetype":
+		mimetype = prefix[38:120].split(b"PK")[0].decode("ascii", "ignore").strip()
+		if mimetype == "application/epub+zip":
+			return "EPUB", mimetype
+		if mimetype.startswith("application/vnd.oasis.opendocument."):
+			extensions = {"text": "ODT", "spreadsheet": "ODS", "presentation": "ODP", "graphics": "ODG"}
+			extension = extensions.get(mimetype.rsplit(".", 1)[-1])
+			if extension is not None:
+				return extension, mimetype
+	if b"[Content_Types].xml" in prefix:
+		for folder, extension, mimetype in OFFICE_FOLDERS:
+			if folder in prefix:
+				return extension, mimetype
+		# an Office file whose parts come in an unexpected order - leave it to ExifTool
+		return None
+	return "ZIP", "application/zip"
+
+def sniff_filetype(prefix):
+	"""Returns (extension, MIME type) for the file starting with prefix, or None if it isn't a format recognised here.
+	Formats that need more than the first few KB to tell apart, like old Office files, are left for ExifTool.
+	...
+	Parameters
+	----------
+	prefix : bytes
+		First few KB of the file
+	"""
+	for offset, magic, extension, mimetype in MAGIC_NUMBERS:
+		if prefix[offset:offset + len(magic)] == magic:
+			return extension, mimetype
+	if _is_bmp(prefix):
+		return "BMP", "image/bmp"
+	if prefix[:4] == b"RIFF" and prefix[8:12] in RIFF_TYPES:
+		return RIFF_TYPES[prefix[8:12]]
+	if prefix[4:8] == b"ftyp":
+		return FTYP_BRANDS.get(prefix[8:12])
+	if prefix[:4] == b"PK\x03\x04":
+		return _sniff_zip(prefix)
+	# MPEG audio frames without an ID3 tag start with an 11-bit frame sync
+	if len(prefix) >= 2 and prefix[0] == 0xff and prefix[1] & 0xe6 == 0xe2:
+		return "MP3", "audio/mpeg"
+	if _starts_with_html_tag(prefix):
+		return "HTML", "text/html"
+	return None
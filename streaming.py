@@ -0,0 +1,507 @@
+#! /usr/bin/env python3
+
+"""
+Module to write downloaded resources to disk as they stream in.
+
+Class "HashingWriter" writes chunks to a file and updates one or more hashes (md5, sha1, sha256...) with the same chunks, so a file never has to be read back from disk just to hash it.
+
+Function "peek" reads the first few KB of a streamed response without losing them, so the download can be judged from its first bytes before anything is written.
+
+Class "Hashes" keeps several hashes of the same data in step; HashingWriter builds on it.
+
+Function "download_resumable" drains a streamed requests response into a file through a HashingWriter, keeping memory use flat however large the resource is. It writes to a ".part" file kept next to the destination. If the connection drops partway, it carries on with HTTP Range requests when the server allows them. If it still can't finish, the ".part" file and a small ".json" note of its validator are left behind so the next attempt at the same URL picks up where this one stopped. A ".lock" file stops two downloads of the same URL at the same time from writing to the same ".part" file.
+
+Function "download_segmented" splits a large resource into byte ranges fetched in parallel into a preallocated file, for servers that give each connection limited throughput.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import hashlib
+import json
+import logging
+import os
+import requests # req
+import socket
+import time
+import urllib3 # req
+import uuid
+
+# for checking on the owner of a lock on Windows
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+STILL_ACTIVE = 259
+
+def peek(response, size=4096):
+	"""Reads up to size bytes from the start of a streamed response and returns them. The bytes are put back in front of the rest of the body, so iter_content still yields the whole body from the start.
+	Returns b"" if the connection fails, leaving the error to be found when the body is downloaded.
+	"""
+	try:
+		prefix = response.raw.read(size, decode_content=True) or b""
+	except (urllib3.exceptions.HTTPError, OSError) as e:
+		logging.info(f"Could not read the start of {response.url}: {e}")
+		return b""
+	original_iter_content = response.iter_content
+
+	def iter_content(chunk_size=1, decode_unicode=False):
+		if prefix:
+			yield prefix
+		yield from original_iter_content(chunk_size, decode_unicode)
+
+	response.iter_content = iter_content
+	return prefix
+
+class Hashes:
+	"""Feeds the same data to several hashlib hashes at once.
+	...
+	Parameters
+	----------
+	algorithms : iterable of str, optional
+		Names of hashlib algorithms to compute. Default is ("md5",).
+
+	Attributes
+	----------
+	bytes_written : int
+		Number of bytes hashed so far
+	bytes_downloaded : int
+		Number of bytes that came over the network in this download, not counting any picked up from an earlier attempt
+	hash_seconds : float
+		Time spent hashing, in seconds
+	"""
+
+	def __init__(self, algorithms=("md5",)):
+		self.hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+		self.bytes_written = 0
+		self.bytes_downloaded = 0
+		self.hash_seconds = 0.0
+
+	def update(self, chunk):
+		started = time.perf_counter()
+		for hash_object in self.hashes.values():
+			hash_object.update(chunk)
+		self.hash_seconds += time.perf_counter() - started
+		self.bytes_written += len(chunk)
+
+	def hexdigests(self):
+		"""Returns a dictionary of algorithm name to hex digest of everything hashed so far
+		"""
+		return {algorithm: hash_object.hexdigest() for algorithm, hash_object in self.hashes.items()}
+
+class HashingWriter(Hashes):
+	"""Writes chunks to a file and feeds them to hashlib hashes in the same pass.
+	...
+	Parameters
+	----------
+	filepath : str
+		Path of the file to write
+	algorithms : iterable of str, optional
+		Names of hashlib algorithms to compute while writing. Default is ("md5",).
+	append : bool, optional
+		Set to True to add to the end of an existing file. Its current contents are hashed first so the digests cover the whole file. Default is False.
+
+	Attributes
+	----------
+	bytes_written : int
+		Size of the file so far, including anything already there when appending
+	"""
+
+	def __init__(self, filepath, algorithms=("md5",), append=False):
+		super().__init__(algorithms)
+		self.filepath = filepath
+		if append and os.path.exists(filepath):
+			# hashlib state can't be saved between runs, so catch the hashes up on what is already on disk
+			with open(filepath, "rb") as f:
+				for chunk in iter(lambda: f.read(1024 * 1024), b""):
+					self.update(chunk)
+			self._file = open(filepath, "ab")
+		else:
+			self._file = open(filepath, "wb")
+
+	def write(self, chunk):
+		self._file.write(chunk)
+		self.update(chunk)
+		self.bytes_downloaded += len(chunk)
+
+	def flush(self):
+		self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+class PartialDownload:
+	"""The ".part" file and ".json" note kept in a directory for an unfinished download of one URL.
+	...
+	Parameters
+	----------
+	directory : str
+		Directory the finished file will be saved in
+	url : str
+		URL being downloaded. The ".part" filename is made from a hash of it, so every attempt at the same URL finds the same file.
+
+	METHODS
+	-------
+
+	lock
+	unlock
+	validator
+	offset
+	save
+	finish
+	discard_state
+	"""
+
+	def __init__(self, directory, url):
+		self.url = url
+		self.directory = directory
+		self.part_path = os.path.join(directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".part")
+		self.state_path = self.part_path + ".json"
+		self.lock_path = self.part_path + ".lock"
+		# False once another download of the same URL holds the shared ".part" file
+		self.shared = True
+		self.locked = False
+
+	def lock(self):
+		"""Takes the ".part" file of this URL with a ".lock" file, so two downloads of the same URL at the same time can't write to it.
+		If another live download holds it, switches to a ".part" file of this attempt's own, named from a UUID, which isn't kept for a later attempt. A lock left by a process that has died is taken over.
+		"""
+		for _ in range(2):
+			try:
+				lock_file = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+			except FileExistsError:
+				if not _stale_lock(self.lock_path):
+					break
+				logging.info(f"Taking over the lock of a dead process on {self.part_path}")
+				try:
+					os.remove(self.lock_path)
+				except FileNotFoundError:
+					pass
+				continue
+			with os.fdopen(lock_file, "w") as f:
+				f.write(f"{socket.gethostname()}:{os.getpid()}")
+			self.locked = True
+			return
+		logging.info(f"{self.url} is already being downloaded to {self.part_path} - downloading this copy separately")
+		self.shared = False
+		self.part_path = os.path.join(self.directory, uuid.uuid4().hex + ".part")
+
+	def unlock(self):
+		if self.locked:
+			self.locked = False
+			try:
+				os.remove(self.lock_path)
+			except FileNotFoundError:
+				pass
+
+	def validator(self):
+		"""Returns the 'ETag' or 'Last-Modified' value saved with the ".part" file, or None if there is nothing to resume
+		"""
+		if not self.shared or not (os.path.exists(self.part_path) and os.path.exists(self.state_path)):
+			return None
+		try:
+			with open(self.state_path) as f:
+				state = json.load(f)
+		except (OSError, ValueError):
+			return None
+		if state.get("url") != self.url:
+			return None
+		return state.get("validator")
+
+	def offset(self):
+		"""Returns the number of bytes already in the ".part" file
+		"""
+		return os.path.getsize(self.part_path)
+
+	def save(self, validator):
+		if self.shared:
+			with open(self.state_path, "w") as f:
+				json.dump({"url": self.url, "validator": validator}, f)
+
+	def finish(self, filepath):
+		"""Moves the completed ".part" file to its final path and removes the note
+		"""
+		os.replace(self.part_path, filepath)
+		self.discard_state()
+
+	def discard_state(self):
+		if self.shared and os.path.exists(self.state_path):
+			os.remove(self.state_path)
+
+def _process_alive(pid):
+	"""Checks whether a process with this id is running on this machine
+	"""
+	if os.name == "nt":
+		# os.kill would end the process on Windows, so ask for its exit code instead
+		kernel32 = ctypes.windll.kernel32
+		handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+		if not handle:
+			return False
+		try:
+			exit_code = ctypes.c_ulong()
+			return bool(kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))) and exit_code.value == STILL_ACTIVE
+		finally:
+			kernel32.CloseHandle(handle)
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	return True
+
+def _stale_lock(lock_path):
+	"""Checks whether a ".lock" file was left by a process on this machine that is no longer running. Locks from other machines are never taken to be stale.
+	"""
+	try:
+		with open(lock_path) as f:
+			hostname, _, pid = f.read().rpartition(":")
+	except OSError:
+		return False
+	if not pid.isdigit():
+		# the owner may not have written its name yet
+		return False
+	return hostname == socket.gethostname() and int(pid) != os.getpid() and not _process_alive(int(pid))
+
+def _validator(response):
+	"""Returns the header a server can use to tell whether a partial file is still current: a strong 'ETag' if there is one, else 'Last-Modified'
+	"""
+	etag = response.headers.get("ETag")
+	if etag is not None and not etag.startswith("W/"):
+		return etag
+	return response.headers.get("Last-Modified")
+
+def _accepts_ranges(response):
+	"""Checks the server will answer Range requests for this response with byte offsets that match what we write to disk
+	"""
+	accept_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+	# offsets into a gzipped body don't line up with the decoded bytes on disk
+	unencoded = response.headers.get("Content-Encoding", "identity").lower() == "identity"
+	return accept_ranges and unencoded and _validator(response) is not None
+
+def _range_request(session, url, offset, validator, request_kwargs, end=None, rate_limiter=None):
+	"""Asks for a resource from offset onwards, or up to and including end if given. If-Range makes the server send the whole thing again if it has changed since.
+	Waits for rate_limiter first if given, like any other request to the host, and lets it see the response.
+	"""
+	headers = dict(request_kwargs.get("headers") or {})
+	headers["Range"] = f"bytes={offset}-{end if end is not None else ''}"
+	headers["If-Range"] = validator
+	headers["Accept-Encoding"] = "identity"
+	kwargs = dict(request_kwargs, headers=headers, stream=True)
+	if rate_limiter is not None:
+		rate_limiter.wait(url)
+	response = session.get(url, **kwargs)
+	if rate_limiter is not None:
+		rate_limiter.check_response(response)
+	response.raise_for_status()
+	return response
+
+def download_resumable(session, response, filepath, algorithms=("md5",), retries=3, chunk_size=100000, rate_limiter=None, **request_kwargs):
+	"""Writes the body of a streamed response to filepath through a ".part" file, hashing it on the way.
+	If the connection drops and the server accepts byte ranges, the download carries on with a Range request, up to retries times. If an earlier run left a ".part" file for the same URL with a matching validator, it is picked up instead of starting again. Another download of the same URL running at the same time writes to a ".part" file of its own (see PartialDownload.lock).
+	Returns the HashingWriter used, so the caller can read bytes_written and hexdigests(). If the download can't be finished, the requests exception is raised and the ".part" file is kept for next time. An OSError is raised if the file can't be written or moved into place.
+	...
+	Parameters
+	----------
+	session : requests.Session
+		Session to make any Range requests through
+	response : requests.Response
+		Response from a request made with stream=True
+	filepath : str
+		Path of the finished file
+	algorithms : iterable of str, optional
+		Names of hashlib algorithms to compute while writing. Default is ("md5",).
+	retries : int, optional
+		Number of times to carry on with a Range request after the connection drops. Default is 3.
+	chunk_size : int, optional
+		Number of bytes read from the connection at a time. Default is 100000.
+	rate_limiter : rate_limiter.RateLimiter, optional
+		Limiter each Range request waits for, so resuming keeps to the host's rate. Default is None: no limit.
+	request_kwargs : optional
+		Passed on to session.get for Range requests, eg proxies, headers, timeout
+	"""
+	url = response.url
+	partial = PartialDownload(os.path.dirname(filepath), url)
+	partial.lock()
+	try:
+		validator = _validator(response)
+		accepts_ranges = _accepts_ranges(response)
+		# a ".part" file is only worth keeping if the server will let us resume it, and the next attempt will find it
+		keep_part = accepts_ranges and partial.shared
+
+		append = False
+		# the ".part" file already holds the whole resource
+		complete = False
+		if accepts_ranges and partial.validator() == validator and partial.offset() > 0:
+			offset = partial.offset()
+			size = int(response.headers.get("Content-Length") or 0)
+			if offset == size:
+				# an earlier attempt wrote everything but didn't move the file into place
+				response.close()
+				append = complete = True
+				logging.info(f"{url} was already downloaded in full to {partial.part_path} - finishing it")
+			elif size and offset > size:
+				logging.info(f"{partial.part_path} is bigger than {url} - starting again")
+			else:
+				response.close()
+				try:
+					response = _range_request(session, url, offset, validator, request_kwargs, rate_limiter=rate_limiter)
+				except requests.exceptions.HTTPError as e:
+					# 416 Range Not Satisfiable: the ".part" file doesn't fit the resource, so start again
+					if e.response is None or e.response.status_code != 416:
+						raise
+					logging.info(f"{url} can't be resumed from byte {offset} - starting again")
+					os.remove(partial.part_path)
+					response = _range_request(session, url, 0, validator, request_kwargs, rate_limiter=rate_limiter)
+				else:
+					# 206 means the server sent just the missing part; 200 means it sent everything again
+					append = response.status_code == 206
+					logging.info(f"Resuming {url} from byte {offset}" if append else f"{url} has changed since the partial download - starting again")
+		if keep_part:
+			partial.save(validator)
+		else:
+			partial.discard_state()
+
+		try:
+			with HashingWriter(partial.part_path, algorithms, append=append) as writer:
+				# a complete ".part" file is only hashed
+				while not complete:
+					try:
+						for chunk in response.iter_content(chunk_size):
+							writer.write(chunk)
+						break
+					except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+						if not accepts_ranges or retries <= 0:
+							raise
+						retries -= 1
+						writer.flush()
+						logging.warning(f"Download of {url} interrupted at byte {writer.bytes_written} - resuming: {e}")
+						response.close()
+						response = _range_request(session, url, writer.bytes_written, validator, request_kwargs, rate_limiter=rate_limiter)
+						if response.status_code != 206:
+							raise requests.exceptions.RequestException(f"{url} changed while it was being downloaded")
+		except Exception:
+			if not keep_part and os.path.exists(partial.part_path):
+				os.remove(partial.part_path)
+			raise
+		finally:
+			response.close()
+
+		partial.finish(filepath)
+	finally:
+		partial.unlock()
+	return writer
+
+def download_segmented(session, response, filepath, algorithms=("md5",), segments=4, min_segment_size=8 * 1024 * 1024, retries=3, chunk_size=100000, rate_limiter=None, host_limiter=None, **request_kwargs):
+	"""Downloads a large resource as several byte ranges at once, each written straight into its place in a preallocated file, then hashes the segments in order.
+	The first segment is read from the response already open; the others are fetched with Range requests. Each segment retries from where it stopped if its connection drops.
+	If the response has no 'Content-Length', isn't big enough to be worth splitting or the server won't take Range requests, falls back to download_resumable.
+	Every segment's connection counts against the host's slots in host_limiter, if given: only as many extra segments are opened as the host has slots free, and with none free the resource is downloaded in one piece.
+	Returns an object with bytes_written, bytes_downloaded, hash_seconds and hexdigests(), like download_resumable.
+	...
+	Parameters
+	----------
+	session : requests.Session
+		Session to make the Range requests through
+	response : requests.Response
+		Response from a request made with stream=True
+	filepath : str
+		Path of the finished file
+	algorithms : iterable of str, optional
+		Names of hashlib algorithms to compute. Default is ("md5",).
+	segments : int, optional
+		Number of ranges to download at the same time. Default is 4.
+	min_segment_size : int, optional
+		Smallest segment worth a connection of its own, in bytes. Resources smaller than segments * min_segment_size are downloaded in one piece. Default is 8 MB.
+	retries : int, optional
+		Number of times each segment carries on after its connection drops. Default is 3.
+	chunk_size : int, optional
+		Number of bytes read from the connection at a time. Default is 100000.
+	rate_limiter : rate_limiter.RateLimiter, optional
+		Limiter each Range request waits for, so the segments keep to the host's rate. Default is None: no limit.
+	host_limiter : downloader.HostLimiter, optional
+		Limiter capping the connections open to each host. The download is taken to hold one slot already; each further segment needs a slot of its own. Default is None: segments are not capped.
+	request_kwargs : optional
+		Passed on to session.get for Range requests, eg proxies, headers, timeout
+	"""
+	size = int(response.headers.get("Content-Length") or 0)
+	if segments <= 1 or size < segments * min_segment_size or not _accepts_ranges(response):
+		return download_resumable(session, response, filepath, algorithms, retries, chunk_size, rate_limiter, **request_kwargs)
+	if host_limiter is None:
+		return _download_segments(session, response, filepath, algorithms, segments, retries, chunk_size, rate_limiter, request_kwargs)
+	with host_limiter.extra_slots(response.url, segments - 1) as extra:
+		if extra == 0:
+			return download_resumable(session, response, filepath, algorithms, retries, chunk_size, rate_limiter, **request_kwargs)
+		return _download_segments(session, response, filepath, algorithms, extra + 1, retries, chunk_size, rate_limiter, request_kwargs)
+
+def _download_segments(session, response, filepath, algorithms, segments, retries, chunk_size, rate_limiter, request_kwargs):
+	"""Downloads the resource as segments byte ranges at once for download_segmented
+	"""
+	size = int(response.headers["Content-Length"])
+	url = response.url
+	validator = _validator(response)
+	part_path = filepath + ".part"
+	bounds = [(number * size // segments, (number + 1) * size // segments - 1) for number in range(segments)]
+	with open(part_path, "wb") as f:
+		f.truncate(size)
+
+	def fetch(number):
+		start, end = bounds[number]
+		position = start
+		attempts_left = retries
+		segment_response = response if number == 0 else None
+		while True:
+			try:
+				if segment_response is None:
+					segment_response = _range_request(session, url, position, validator, request_kwargs, end=end, rate_limiter=rate_limiter)
+					if segment_response.status_code != 206:
+						raise requests.exceptions.RequestException(f"{url} changed while it was being downloaded")
+				with open(part_path, "r+b") as f:
+					f.seek(position)
+					for chunk in segment_response.iter_content(chunk_size):
+						# the first segment is read from the full response, so stop at the end of the segment
+						chunk = chunk[:end + 1 - position]
+						f.write(chunk)
+						position += len(chunk)
+						if position > end:
+							break
+				if position <= end:
+					raise requests.exceptions.ChunkedEncodingError(f"Segment of {url} ended at byte {position} instead of {end + 1}")
+				return
+			except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+				if attempts_left <= 0:
+					raise
+				attempts_left -= 1
+				logging.warning(f"Segment of {url} interrupted at byte {position} - resuming: {e}")
+			finally:
+				if segment_response is not None:
+					segment_response.close()
+					segment_response = None
+
+	hashes = Hashes(algorithms)
+	try:
+		with ThreadPoolExecutor(max_workers=segments) as executor:
+			futures = [executor.submit(fetch, number) for number in range(segments)]
+			# hash each segment as soon as it and all the ones before it are done, while later segments are still downloading
+			# unbuffered, so nothing read before a segment was finished can be served from a stale buffer
+			with open(part_path, "rb", buffering=0) as f:
+				for (start, end), future in zip(bounds, futures):
+					future.result()
+					f.seek(start)
+					remaining = end + 1 - start
+					while remaining:
+						chunk = f.read(min(1024 * 1024, remaining))
+						hashes.update(chunk)
+						remaining -= len(chunk)
+	except Exception:
+		os.remove(part_path)
+		raise
+	finally:
+		response.close()
+
+	os.replace(part_path, filepath)
+	hashes.bytes_downloaded = size
+	return hashes
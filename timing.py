@@ -0,0 +1,68 @@
+#! /usr/bin/env python3
+
+"""
+Module to time the stages of a download.
+
+Class "StageTimer" adds up the time spent in each named stage of one download, using a monotonic clock so changes to the system clock don't skew it. The downloaders keep one per resource and store its totals as "time_<stage>" fields, so slow batches can be broken down with a query like:
+
+	SELECT AVG(time_request), AVG(time_download), AVG(time_metadata), AVG(time_db) FROM resources;
+
+"""
+
+from contextlib import contextmanager
+import time
+
+# stages timed by the downloaders, in the order they run
+STAGES = ("wait", "head", "request", "sniff", "download", "hash", "metadata", "rename", "db")
+
+class StageTimer:
+	"""Adds up the seconds spent in each stage of a download. A stage can be entered more than once, eg "db" for every save.
+	...
+
+	METHODS
+	-------
+
+	stage
+	add
+	finish
+	total
+	as_fields
+	"""
+
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.finished = None
+		self.seconds = {}
+
+	@contextmanager
+	def stage(self, name):
+		"""Times the with block and adds it to the named stage
+		"""
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - started)
+
+	def add(self, name, seconds):
+		"""Adds seconds measured elsewhere to the named stage
+		"""
+		self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+
+	def finish(self):
+		"""Stops the clock for total
+		"""
+		self.finished = time.perf_counter()
+
+	def total(self):
+		"""Seconds from creating the timer to finish, or to now if it hasn't finished
+		"""
+		end = self.finished if self.finished is not None else time.perf_counter()
+		return end - self.started
+
+	def as_fields(self):
+		"""Returns a dictionary of "time_<stage>" to seconds for every stage in STAGES, plus "time_total". Stages that never ran are None.
+		"""
+		fields = {f"time_{name}": round(self.seconds[name], 6) if name in self.seconds else None for name in STAGES}
+		fields["time_total"] = round(self.total(), 6)
+		return fields